@@ -1,11 +1,14 @@
 from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin import actions
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, Http404, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.utils.encoding import force_unicode
 
-from navigation.models import Menu, MenuItem, MenuPage, MenuFolder, MenuLink
+from navigation.bulk import reorder_items
+from navigation.models import Menu, MenuPage, MenuFolder, MenuLink
+from navigation.prefetch import prefetch_menu_items
 
 
 # Account for the fact that admin media may need to be served over SSL.
@@ -33,7 +36,13 @@ class MenuAdmin(admin.ModelAdmin):
 
     def render_change_form(self, request, context, add=False, change=False, \
         form_url='', obj=None):
-        context.update({'obj': obj})
+        # Load the menu's items once, with their leaf objects (and the pages
+        # of page leaves, which their names are made of) attached, so that
+        # the tree renders without a query per node.
+        items = []
+        if obj is not None:
+            items = prefetch_menu_items(list(obj.items), ('page',))
+        context.update({'obj': obj, 'items': items})
         return super(MenuAdmin, self).render_change_form(request, context, \
             add, change, form_url, obj)
 
@@ -48,16 +57,18 @@ class MenuAdmin(admin.ModelAdmin):
 
     def parents_orders(self, request):
         if request.method == 'POST':
+            changes = {}
             for item_id, values in request.POST.iteritems():
                 menu_id, po = values.split(':')
                 parent, order = po.split(',')
-                item = MenuItem.objects.get(pk=int(item_id))
                 try:
-                    item.parent = MenuItem.objects.get(pk=parent)
+                    parent = int(parent)
                 except ValueError:
-                    item.parent = None
-                item.order = order
-                item.save()
+                    parent = None
+                changes[int(item_id)] = (parent, int(order))
+            # Apply every change at once and rebuild the tree a single time,
+            # rather than saving (and reshuffling the tree for) each item.
+            reorder_items(changes)
             return HttpResponse()
         raise Http404
 
@@ -69,14 +80,26 @@ class MenuAdmin(admin.ModelAdmin):
         from navigation.cache import site_nav
         menu = get_object_or_404(Menu, pk=pk)
         if menu.name in site_nav:
-            site_nav.recache(menu.name)
+            site_nav.recache(menu.name, 'rebuild_view')
             return HttpResponse('"%s" navigation rebuilt.' % menu.name)
         else:
             return HttpResponse('"%s" navigation could not be found.' % menu.name)
 
 
+def delete_selected(modeladmin, request, queryset):
+    """
+    The admin's bulk delete action, recaching each affected menu once rather
+    than once per menu item the deletion cascades to.
+    """
+    from navigation.cache import site_nav
+    with site_nav.coalesced():
+        return actions.delete_selected(modeladmin, request, queryset)
+delete_selected.short_description = actions.delete_selected.short_description
+
+
 class MenuLeafAdmin(admin.ModelAdmin):
     change_form_template = 'navigation/menuleaf_change.html'
+    actions = [delete_selected]
 
     def add_view(self, request, form_url='', extra_context=None):
         if not request.GET.has_key('menu'):
@@ -0,0 +1,71 @@
+from django.conf import settings
+
+
+# The alias of the cache (from ``settings.CACHES``) used to share menu version
+# stamps between processes. It must be a cache that all processes can see
+# (e.g. memcached, a database or file based cache) for changes made in one
+# process to reach the others.
+NAVIGATION_VERSION_CACHE = getattr(settings, 'NAVIGATION_VERSION_CACHE', 'default')
+
+# How long, in seconds, shared menu version stamps are kept.
+NAVIGATION_VERSION_TIMEOUT = getattr(settings, 'NAVIGATION_VERSION_TIMEOUT', 60 * 60 * 24 * 30)
+
+# The minimum number of seconds between two checks of a menu's shared version
+# stamp. The default of 0 checks before every render.
+NAVIGATION_VERSION_CHECK_INTERVAL = getattr(settings, 'NAVIGATION_VERSION_CHECK_INTERVAL', 0)
+
+# The path of a snapshot file of the built navigation trees, written by the
+# ``navigation_snapshot`` management command. When set, processes load their
+# menus from the snapshot at startup and only build from the database those
+# that are missing from it or whose version stamp has since moved. A menu with
+# no stamp in the version cache at all (after a deploy or a cache flush, or with
+# a per-process cache) is stamped with the snapshot's version and loaded from
+# it, so make sure snapshots are written again whenever menus change, or bound
+# their age with ``NAVIGATION_SNAPSHOT_MAX_AGE``.
+NAVIGATION_SNAPSHOT_PATH = getattr(settings, 'NAVIGATION_SNAPSHOT_PATH', None)
+
+# Snapshots older than this many seconds are ignored. None means no limit.
+NAVIGATION_SNAPSHOT_MAX_AGE = getattr(settings, 'NAVIGATION_SNAPSHOT_MAX_AGE', None)
+
+# The renderer ``fast_menu`` uses for each menu, keyed by ``Menu.template``.
+# Values are either the name of a built-in renderer ('template', 'compiled' or
+# 'string'; see ``navigation.renderers``) or the dotted path to a renderer
+# class. Templates not listed here use ``NAVIGATION_DEFAULT_RENDERER``. The
+# 'string' renderer only stands in for ``navigation/node.html``, and raises
+# ``ImproperlyConfigured`` for any other template.
+NAVIGATION_RENDERERS = getattr(settings, 'NAVIGATION_RENDERERS', {})
+NAVIGATION_DEFAULT_RENDERER = getattr(settings, 'NAVIGATION_DEFAULT_RENDERER', 'template')
+
+# The maximum number of rendered ``fast_menu`` fragments kept in memory by each
+# process. The fragment cache is off (0) by default: node templates are passed
+# the request, and a cached fragment is served to every user of the same
+# audience (anonymous or authenticated) on a matching path. Only turn
+# it on if your menu templates render nothing else from the request.
+NAVIGATION_FRAGMENT_CACHE_SIZE = getattr(settings, 'NAVIGATION_FRAGMENT_CACHE_SIZE', 0)
+
+# When True, built menus are frozen into the compact, read-only format of
+# ``navigation.compact``, which uses much less memory for large trees. Edits
+# then rebuild the affected menus instead of patching them.
+NAVIGATION_COMPACT_TREES = getattr(settings, 'NAVIGATION_COMPACT_TREES', False)
+
+# The number of rows inserted per query by the bulk menu loader.
+NAVIGATION_BULK_BATCH_SIZE = getattr(settings, 'NAVIGATION_BULK_BATCH_SIZE', 500)
+
+# The dotted path to a callable that is passed every instrumentation event (see
+# ``navigation.instrumentation``) as ``callback(event, **data)``, e.g. to feed
+# them to a metrics pipeline. None disables the callback.
+NAVIGATION_STATS_CALLBACK = getattr(settings, 'NAVIGATION_STATS_CALLBACK', None)
+
+# How signal handlers recache menus. 'immediate' recaches as soon as a change
+# is saved; 'coalesce' collects the menus changed during a request and
+# recaches each of them once at the end, which requires
+# ``navigation.middleware.CoalescedRecacheMiddleware``; 'background' collects
+# them the same way, then rebuilds them on a pool of background threads so
+# that saves return immediately, swapping each rebuilt tree in atomically once
+# it is complete. Outside of requests (e.g. in management commands), changes
+# are recached immediately unless made within ``site_nav.coalesced()``.
+NAVIGATION_RECACHE_MODE = getattr(settings, 'NAVIGATION_RECACHE_MODE', 'immediate')
+
+# The number of threads rebuilding menus with
+# ``NAVIGATION_RECACHE_MODE = 'background'``.
+NAVIGATION_BACKGROUND_THREADS = getattr(settings, 'NAVIGATION_BACKGROUND_THREADS', 1)
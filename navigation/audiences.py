@@ -0,0 +1,117 @@
+"""
+Per-audience variants of built navigation trees.
+
+Every menu is pruned, when it is grown, into one variant per audience (see
+``get_audience``), with the nodes that audience must not
+see already removed, so that rendering needs no visibility checks:
+
+* pages hidden from the navigation by their layout (``show_in_nav``) are
+  removed for everyone, as are the children of pages whose layout hides them
+  (``show_children``), and so are unpublished pages;
+* anonymous users only see public pages;
+* authenticated users, staff included, see every published page.
+
+Subtrees from which nothing is removed are shared between the variants and
+the full tree. The variants of compact trees (see ``navigation.compact``)
+share the full tree's columns.
+"""
+import copy
+
+from navigation.compact import CompactNode
+
+
+AUDIENCES = ('anonymous', 'authenticated')
+
+
+def get_audience(request):
+    """
+    Returns the audience of the given request: 'anonymous' or 'authenticated'.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated():
+        return 'anonymous'
+    return 'authenticated'
+
+
+def is_visible(node, audience):
+    """
+    Returns True if the given node is shown to the given audience.
+    """
+    if node.type != 'page':
+        return True
+    if not node.show_in_nav:
+        return False
+    if node.status != 'published':
+        return False
+    return audience == 'authenticated' or node.visibility == 'public'
+
+
+def _prune_node(node, audience):
+    """
+    Returns the given node without its descendants hidden from the given
+    audience; the node itself if none are.
+    """
+    if node.type == 'page' and not node.show_children:
+        children = []
+    else:
+        children = [(key, _prune_node(child, audience)) for key, child in node.items() \
+            if is_visible(child, audience)]
+    if len(children) == len(node.children) and \
+        all(pruned is original for (key, pruned), original in zip(children, node.values())):
+        return node
+    node = copy.copy(node)
+    node.children = node.children.__class__(children)
+    return node
+
+
+def prune(menu_list, audience):
+    """
+    Returns the given list of top-level nodes, pruned of the nodes hidden
+    from the given audience.
+    """
+    if menu_list and isinstance(menu_list[0], CompactNode):
+        return _prune_compact(menu_list, audience)
+    pruned = [_prune_node(node, audience) for node in menu_list if is_visible(node, audience)]
+    for position, node in enumerate(pruned):
+        first, last = position == 0, position == len(pruned) - 1
+        if bool(getattr(node, 'first', False)) != first or bool(getattr(node, 'last', False)) != last:
+            # Top-level nodes are flagged as first and last, which pruning
+            # can change.
+            node = pruned[position] = copy.copy(node)
+            node.first, node.last = first, last
+    return pruned
+
+
+def _hidden_indexes(node, audience, hidden):
+    """
+    Adds the indexes of the descendants of the given ``CompactNode`` whose
+    subtrees are hidden from the given audience to the ``hidden`` list.
+    """
+    for child in node.values():
+        if (node.type == 'page' and not node.show_children) or not is_visible(child, audience):
+            hidden.append(child.index)
+        else:
+            _hidden_indexes(child, audience, hidden)
+
+
+def _prune_compact(menu_list, audience):
+    """
+    Returns the given list of top-level ``CompactNode`` objects, pruned of the
+    nodes hidden from the given audience, as views onto a pruned copy of their
+    tree.
+    """
+    hidden = []
+    for node in menu_list:
+        if is_visible(node, audience):
+            _hidden_indexes(node, audience, hidden)
+        else:
+            hidden.append(node.index)
+    return menu_list[0].tree.prune(hidden).nodes()
+
+
+def prune_all(menu_list):
+    """
+    Returns a dictionary of the variants of the given list of top-level
+    nodes, keyed by audience.
+    """
+    return dict([(audience, prune(menu_list, audience)) for audience in AUDIENCES])
@@ -0,0 +1,70 @@
+import logging
+import Queue
+import threading
+
+from django.db import connection
+
+
+logger = logging.getLogger('navigation')
+
+
+class BackgroundRecacher(object):
+    """
+    Runs menu recaches on a small pool of daemon threads, so that the thread
+    which asked for a recache (typically an admin request) doesn't wait for
+    the menu to be rebuilt.
+
+    Each menu is queued at most once at a time: asking for a recache of a menu
+    that is already waiting in the queue is a no-op, as the queued recache
+    will pick up the latest changes anyway. A menu can be queued again as soon
+    as its recache starts; ``SiteNav`` runs rebuilds of the same menu one at a
+    time, so a recache picked up by another thread waits for the running one
+    to finish instead of racing it.
+    """
+
+    def __init__(self, recache, threads=1):
+        self.recache = recache
+        self.threads = threads
+        self.queue = Queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.workers = []
+
+    def submit(self, key, trigger=None):
+        """
+        Queue a recache of the menu with the given key.
+        """
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+            self._start()
+        self.queue.put((key, trigger))
+
+    def join(self):
+        """
+        Block until every queued recache has been run.
+        """
+        self.queue.join()
+
+    def _start(self):
+        while len(self.workers) < self.threads:
+            worker = threading.Thread(target=self._work, name='navigation-recache-%d' % len(self.workers))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _work(self):
+        while True:
+            key, trigger = self.queue.get()
+            with self.lock:
+                # Changes made from here on need another recache.
+                self.pending.discard(key)
+            try:
+                self.recache(key, trigger)
+            except Exception:
+                logger.exception("Background recache of menu %r failed", key)
+            finally:
+                # Don't leave this thread's connection open between jobs.
+                connection.close()
+                self.queue.task_done()
@@ -0,0 +1,293 @@
+"""
+Tools for measuring the performance of the navigation.
+
+``generate_pages`` and ``generate_menu`` build synthetic page trees and menus
+of a given width, depth and mix of node types; ``run_benchmarks`` times the
+main stages of building, rendering and recaching them, counting queries and
+the memory each stage adds to the process, and returns the results as a JSON-serializable
+dictionary. The ``navigation_benchmark`` management command runs the whole
+suite against a throwaway SQLite database.
+"""
+from contextlib import contextmanager
+import random
+import resource
+import sys
+import time
+
+import django
+from django.db import connection
+from django.template import Context, Template
+from django.test.client import RequestFactory
+
+from navigation.bulk import DUMP_FORMAT, load_menus
+from navigation.fragments import fragment_cache
+from navigation.models import Menu, MenuFolder
+from navigation.renderers import RENDERERS
+
+from pagemanager.models import Page
+from pagemanager.signals import page_edited, page_moved
+
+
+# The version of the format of the results returned by ``run_benchmarks``.
+RESULTS_FORMAT = 2
+
+
+@contextmanager
+def fragment_cache_size(max_size):
+    """
+    Resize the ``fast_menu`` fragment cache, emptied, for the duration of the
+    block: to 0 to turn it off so that every render is timed, or to some size
+    to time cached renders whatever ``NAVIGATION_FRAGMENT_CACHE_SIZE`` is.
+    """
+    previous_size = fragment_cache.max_size
+    fragment_cache.max_size = max_size
+    fragment_cache.clear()
+    try:
+        yield
+    finally:
+        fragment_cache.max_size = previous_size
+        fragment_cache.clear()
+
+
+def time_renderers(nav_name, path='/', iterations=100, renderers=None):
+    """
+    Render the menu with the given name at the given path ``iterations`` times
+    with each of the given renderers (all built-in renderers by default), and
+    return a dictionary of the average number of seconds per render, keyed by
+    renderer name.
+    """
+    from navigation.templatetags.navigation_tags import fast_menu
+    request = RequestFactory().get(path)
+    results = {}
+    with fragment_cache_size(0):
+        for name in renderers or sorted(RENDERERS):
+            # Render once outside of the timing to build the menu and compile
+            # any templates.
+            fast_menu(request, nav_name, renderer=name)
+            start = time.time()
+            for i in range(iterations):
+                fast_menu(request, nav_name, renderer=name)
+            results[name] = (time.time() - start) / iterations
+    return results
+
+
+def create_page(parent, slug, title):
+    """
+    The default page factory of ``generate_pages``: a published, public page.
+    Projects whose page model requires more fields can pass their own.
+    """
+    page = Page(parent=parent, slug=slug, title=title, status='published', visibility='public')
+    page.save()
+    return page
+
+
+def generate_pages(width, depth, prefix='bench', factory=create_page):
+    """
+    Create a tree of pages ``width`` pages wide at every level and ``depth``
+    levels deep, under a single root page. Returns the list of all pages
+    created, root first.
+    """
+    root = factory(None, prefix, prefix.title())
+    pages = [root]
+
+    def grow(parent, level):
+        if level > depth:
+            return
+        for i in range(width):
+            slug = '%s-%d-%d' % (prefix, level, i)
+            page = factory(parent, slug, slug.replace('-', ' ').title())
+            pages.append(page)
+            grow(page, level + 1)
+
+    grow(root, 1)
+    return pages
+
+
+def parse_mix(mix):
+    """
+    Parse a mix of node types such as ``"folder=1,link=1,page=2"`` into a
+    dictionary of relative weights.
+    """
+    weights = {}
+    for part in mix.split(','):
+        node_type, _, weight = part.partition('=')
+        if node_type.strip() not in ('folder', 'link', 'page'):
+            raise ValueError('Unknown node type: %r' % node_type)
+        weights[node_type.strip()] = int(weight or 1)
+    return weights
+
+
+def generate_menu(name, width, depth, mix, pages, page_depth=1, seed=0):
+    """
+    Create a menu called ``name`` that is ``width`` items wide at every level
+    and up to ``depth`` levels deep, with folders, links and pages chosen at
+    random according to the weights in ``mix``. Only folders have children;
+    page items point at pages picked from ``pages`` and show ``page_depth``
+    levels of descendants. Returns the new ``Menu``.
+    """
+    rng = random.Random(seed)
+    choices = []
+    for node_type, weight in sorted(mix.items()):
+        choices.extend([node_type] * weight)
+
+    def items(level):
+        entries = []
+        for i in range(width):
+            node_type = rng.choice(choices)
+            title = '%s %d.%d' % (node_type.title(), level, i)
+            entry = {'type': node_type, 'order': i, 'html_class_name': '', 'children': []}
+            if node_type == 'folder':
+                entry['name'] = title
+                if level < depth:
+                    entry['children'] = items(level + 1)
+            elif node_type == 'link':
+                entry.update({'name': title, 'url': '/%s/%d/%d/' % (name, level, i)})
+            else:
+                entry.update({'page': rng.choice(pages).materialized_path, 'depth': page_depth})
+            entries.append(entry)
+        return entries
+
+    data = {
+        'format': DUMP_FORMAT,
+        'menus': [{'name': name, 'template': 'navigation/node.html', 'items': items(1)}],
+    }
+    return load_menus(data, replace=True)[0]
+
+
+def _max_rss_kb():
+    """
+    Returns the peak resident set size of the process so far, in KB.
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Mac OS X reports it in bytes, other systems in KB.
+    if sys.platform == 'darwin':
+        max_rss /= 1024
+    return max_rss
+
+
+def _rss_kb():
+    """
+    Returns the current resident set size of the process in KB, or None where
+    it can't be read (anywhere but Linux).
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, ValueError, IndexError):
+        return None
+    return pages * resource.getpagesize() / 1024
+
+
+def measure(name, function, iterations=1):
+    """
+    Call ``function`` ``iterations`` times and return a dictionary of the
+    stage's name, wall time and queries, and of the memory it added to the
+    process:
+
+    * ``rss_delta_kb``, the growth of the resident set size over the stage
+      (None where it can't be read);
+    * ``max_rss_growth_kb``, how far the stage raised the process' peak
+      resident set size, which is 0 for stages that stay below the peak
+      reached by earlier ones.
+    """
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    connection.queries = []
+    rss, max_rss = _rss_kb(), _max_rss_kb()
+    start = time.time()
+    try:
+        for i in range(iterations):
+            function()
+        wall_time = time.time() - start
+        queries = len(connection.queries)
+        rss_delta = None
+        if rss is not None:
+            rss_delta = _rss_kb() - rss
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+        connection.queries = []
+    return {
+        'stage': name,
+        'iterations': iterations,
+        'wall_time': wall_time,
+        'mean_time': wall_time / iterations,
+        'queries': queries,
+        'mean_queries': float(queries) / iterations,
+        'rss_delta_kb': rss_delta,
+        'max_rss_growth_kb': _max_rss_kb() - max_rss,
+    }
+
+
+def run_benchmarks(width=5, depth=3, mix='folder=1,link=1,page=2', page_width=5, \
+    page_depth=3, iterations=20, page_factory=create_page):
+    """
+    Generate a synthetic page tree and menu and time the main stages of the
+    navigation against them. Returns a JSON-serializable dictionary of the
+    parameters and of the results of each stage.
+    """
+    from navigation import cache
+    from navigation.templatetags import navigation_tags
+
+    pages = generate_pages(page_width, page_depth, factory=page_factory)
+    menu = generate_menu('benchmark', width, depth, parse_mix(mix), pages, page_depth)
+    # Start from an empty SiteNav, so that nothing built earlier is reused.
+    cache.site_nav = site_nav = cache.SiteNav(snapshot_path=None)
+    request = RequestFactory().get('/%s/' % pages[-1].materialized_path)
+    results = []
+
+    results.append(measure('grow', lambda: cache.SiteNav.grow(menu), iterations))
+    site_nav[menu.name]
+    with fragment_cache_size(0):
+        for name in sorted(RENDERERS):
+            results.append(measure('fast_menu:%s' % name, \
+                lambda: navigation_tags.fast_menu(request, menu.name, renderer=name), iterations))
+    with fragment_cache_size(1):
+        navigation_tags.fast_menu(request, menu.name)
+        results.append(measure('fast_menu:cached', \
+            lambda: navigation_tags.fast_menu(request, menu.name), iterations))
+
+    # The {% menu %} tag renders the whole menu with a single template.
+    Menu.objects.filter(pk=menu.pk).update(template='navigation/menu.html')
+    menu_tag = Template('{% load navigation_tags %}{% menu "benchmark" %}')
+
+    def render_cold():
+        navigation_tags._loaded_menus.clear()
+        menu_tag.render(Context({'request': request}))
+
+    results.append(measure('menu_tag:cold', render_cold, iterations))
+    results.append(measure('menu_tag:warm', \
+        lambda: menu_tag.render(Context({'request': request})), iterations))
+
+    # Signal handlers and recaching.
+    page_ids = [pk for node_type, pk in site_nav.node_index if node_type == 'page']
+    folder_ids = [pk for node_type, pk in site_nav.node_index if node_type == 'folder']
+    if folder_ids:
+        folder = MenuFolder.objects.get(pk=folder_ids[0])
+        results.append(measure('signal:folder_save', lambda: cache.folder_save( \
+            MenuFolder, folder, False, connection.alias), iterations))
+    if page_ids:
+        page = Page.objects.get(pk=page_ids[0])
+        results.append(measure('signal:page_edited', \
+            lambda: page_edited.send(sender=Page, page=page), iterations))
+        results.append(measure('signal:page_moved', \
+            lambda: page_moved.send(sender=Page, branch_ids=page_ids[:1]), iterations))
+    results.append(measure('recache', lambda: site_nav.recache(menu.name), iterations))
+
+    return {
+        'format': RESULTS_FORMAT,
+        'created': time.time(),
+        'django': django.get_version(),
+        'parameters': {
+            'width': width,
+            'depth': depth,
+            'mix': mix,
+            'page_width': page_width,
+            'page_depth': page_depth,
+            'iterations': iterations,
+        },
+        'sizes': {
+            'pages': len(pages),
+            'menu_nodes': site_nav.node_count(menu.name),
+        },
+        'results': results,
+    }
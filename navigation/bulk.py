@@ -0,0 +1,318 @@
+"""
+Bulk operations on menu trees that skip django-mptt's per-save bookkeeping and
+rebuild each affected tree once instead.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models import Max, Q
+from django.db.models.sql.subqueries import DeleteQuery
+
+from navigation.app_settings import NAVIGATION_BULK_BATCH_SIZE
+from navigation.models import Menu, MenuFolder, MenuItem, MenuLink, MenuPage
+from navigation.prefetch import prefetch_menu_items
+
+from pagemanager.models import Page
+
+
+# The version of the format written by ``dump_menus``.
+DUMP_FORMAT = 1
+
+# The leaf models of each item type in dumps, and the fields dumped for each.
+LEAF_MODELS = {
+    'folder': MenuFolder,
+    'link': MenuLink,
+    'page': MenuPage,
+}
+LEAF_FIELDS = {
+    'folder': ('name', 'html_class_name'),
+    'link': ('name', 'url', 'html_class_name'),
+    'page': ('depth', 'html_class_name'),
+}
+
+
+TREE_FIELDS = ('parent_id', 'order', 'tree_id', 'lft', 'rght', 'level')
+
+
+def compute_tree_fields(items, tree_ids):
+    """
+    Given a list of ``MenuItem`` objects whose ``parent_id`` and ``order`` are
+    current, return a dictionary mapping each item's primary key to its
+    ``(parent id, order, tree id, left, right, level)`` values.
+
+    Siblings are ordered by ``order``, then by their current position.
+    Top-level items take their tree ids, in order, from ``tree_ids``, which
+    must be long enough. Items whose parent isn't among the given items, or
+    which are part of a cycle, become top-level items.
+    """
+    by_pk = dict([(item.pk, item) for item in items])
+    position = lambda item: (item.order, item.tree_id or 0, item.lft or 0, item.pk)
+    children = {}
+    for item in items:
+        parent_id = item.parent_id in by_pk and item.parent_id or None
+        children.setdefault(parent_id, []).append(item)
+    for siblings in children.values():
+        siblings.sort(key=position)
+
+    fields = {}
+
+    def number(item, parent_id, tree_id, left, level):
+        right = left + 1
+        for child in children.get(item.pk, []):
+            right = number(child, item.pk, tree_id, right, level + 1) + 1
+        fields[item.pk] = (parent_id, item.order, tree_id, left, right, level)
+        return right
+
+    roots = list(children.get(None, []))
+    tree_ids = iter(tree_ids)
+    for root in roots:
+        number(root, None, tree_ids.next(), 1, 0)
+    # Anything left over is part of a cycle.
+    orphans = sorted([item for item in items if item.pk not in fields], key=position)
+    while orphans:
+        children[orphans[0].parent_id].remove(orphans[0])
+        number(orphans[0], None, tree_ids.next(), 1, 0)
+        orphans = [item for item in orphans if item.pk not in fields]
+    return fields
+
+
+def allocate_tree_ids(items, count):
+    """
+    Returns ``count`` tree ids for top-level items: those already used by the
+    given items, followed by unused ones if more are needed.
+    """
+    tree_ids = sorted(set([item.tree_id for item in items if item.tree_id is not None]))
+    if len(tree_ids) < count:
+        highest = MenuItem.objects.aggregate(highest=Max('tree_id'))['highest'] or 0
+        tree_ids.extend(range(highest + 1, highest + 1 + count - len(tree_ids)))
+    return tree_ids[:count]
+
+
+def rebuild_menu_tree(menu, changes=None):
+    """
+    Recompute the MPTT fields of every item in the given menu's trees after
+    applying ``changes``, a dictionary mapping item primary keys to ``(parent
+    id, order)`` tuples, and write the rows that differ. Returns the number
+    of rows written.
+    """
+    changes = changes or {}
+    menu_trees = MenuItem.objects.filter(menu=menu, level=0).values('tree_id')
+    items = list(MenuItem.objects.filter(Q(menu=menu) | Q(tree_id__in=menu_trees)))
+    current = dict([(item.pk, tuple(getattr(item, f) for f in TREE_FIELDS)) for item in items])
+    for item in items:
+        if item.pk in changes:
+            item.parent_id, item.order = changes[item.pk]
+    # Every item could become a top-level item.
+    fields = compute_tree_fields(items, allocate_tree_ids(items, len(items)))
+    written = 0
+    for pk, values in fields.items():
+        if values != current[pk]:
+            MenuItem.objects.filter(pk=pk).update(**dict(
+                [(f == 'parent_id' and 'parent' or f, v) for f, v in zip(TREE_FIELDS, values)]
+            ))
+            written += 1
+    return written
+
+
+@transaction.commit_on_success
+def _reorder_items(changes):
+    menu_ids = set(MenuItem.objects.filter(pk__in=changes.keys()) \
+        .values_list('menu', flat=True))
+    menus = list(Menu.objects.filter(pk__in=[pk for pk in menu_ids if pk is not None]))
+    for menu in menus:
+        rebuild_menu_tree(menu, changes)
+    return menus
+
+
+def reorder_items(changes):
+    """
+    Apply the given parent and order changes, a dictionary mapping item
+    primary keys to ``(parent id, order)`` tuples, in a single transaction,
+    rebuild the tree of each affected menu once and then recache each of
+    those menus once.
+    """
+    from navigation.cache import site_nav
+    menus = _reorder_items(changes)
+    for menu in menus:
+        site_nav.recache(menu.name, 'reorder_items')
+    return menus
+
+
+def dump_menu(menu):
+    """
+    Returns a JSON-serializable dictionary describing the given menu and the
+    full tree of its items. Pages are referred to by their materialized path,
+    so that dumps can be loaded into databases with different page ids.
+    """
+    menu_trees = MenuItem.objects.filter(menu=menu, level=0).values('tree_id')
+    items = list(MenuItem.objects.filter(tree_id__in=menu_trees).order_by('tree_id', 'lft'))
+    prefetch_menu_items(items, ('page',))
+    children = {}
+    for item in items:
+        children.setdefault(item.parent_id, []).append(item)
+
+    def describe(item):
+        leaf = item.obj
+        data = {'type': leaf.node_type, 'order': item.order}
+        for field in LEAF_FIELDS[leaf.node_type]:
+            data[field] = getattr(leaf, field)
+        if leaf.node_type == 'page':
+            data['page'] = leaf.page.materialized_path
+        data['children'] = [describe(child) for child in children.get(item.pk, [])]
+        return data
+
+    return {
+        'name': menu.name,
+        'template': menu.template,
+        'items': [describe(item) for item in children.get(None, []) if item.menu_id == menu.pk],
+    }
+
+
+def dump_menus(menus):
+    return {
+        'format': DUMP_FORMAT,
+        'menus': [dump_menu(menu) for menu in menus],
+    }
+
+
+def _allocate_pks(model, objects):
+    """
+    Give the given new objects consecutive primary keys after the highest one
+    in use, so that they can be inserted in bulk and still be referred to.
+    """
+    highest = model._default_manager.aggregate(highest=Max('pk'))['highest'] or 0
+    for pk, obj in enumerate(objects, highest + 1):
+        obj.pk = pk
+
+
+def _bulk_insert(model, objects):
+    """
+    Insert the given objects, which already have primary keys, in batches,
+    bypassing their ``save`` methods. Then bring the table's primary key
+    sequence up to date, on databases that have one.
+    """
+    manager = model._default_manager
+    for start in range(0, len(objects), NAVIGATION_BULK_BATCH_SIZE):
+        batch = objects[start:start + NAVIGATION_BULK_BATCH_SIZE]
+        if hasattr(manager, 'bulk_create'):
+            manager.bulk_create(batch)
+        else:
+            for obj in batch:
+                obj.save_base(raw=True, force_insert=True)
+    connection = connections[router.db_for_write(model)]
+    statements = connection.ops.sequence_reset_sql(no_style(), [model])
+    if statements:
+        cursor = connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def _delete_menu_items(menu):
+    """
+    Delete every item of the given menu, and the leaf objects of those items,
+    without sending a signal (and so a recache) for each of them.
+    """
+    menu_trees = MenuItem.objects.filter(menu=menu, level=0).values('tree_id')
+    items = list(MenuItem.objects.filter(Q(menu=menu) | Q(tree_id__in=menu_trees)))
+    leaves = {}
+    for item in items:
+        leaves.setdefault(item.obj_type_id, set()).add(item.obj_id)
+    using = router.db_for_write(MenuItem)
+    DeleteQuery(MenuItem).delete_batch([item.pk for item in items], using)
+    for ct_id, pks in leaves.items():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        DeleteQuery(model).delete_batch(list(pks), using)
+
+
+@transaction.commit_on_success
+def _load_menus(data, replace):
+    if data.get('format') != DUMP_FORMAT:
+        raise ValueError('Unsupported menu dump format: %r' % data.get('format'))
+
+    # Look all of the pages up at once.
+    paths = set()
+
+    def collect_paths(entries):
+        for entry in entries:
+            if entry['type'] == 'page':
+                paths.add(entry['page'])
+            collect_paths(entry.get('children', []))
+
+    for menu_data in data['menus']:
+        collect_paths(menu_data['items'])
+    pages = dict([(page.materialized_path, page) for page in \
+        Page.objects.filter(materialized_path__in=list(paths))])
+    missing = paths - set(pages)
+    if missing:
+        raise ValueError('Unknown pages: %s' % ', '.join(sorted(missing)))
+
+    leaves = dict([(node_type, []) for node_type in LEAF_MODELS])
+    items = []
+    menus = []
+    for menu_data in data['menus']:
+        try:
+            menu = Menu.objects.get(name=menu_data['name'])
+        except Menu.DoesNotExist:
+            menu = Menu(name=menu_data['name'])
+        else:
+            if not replace:
+                raise ValueError('The "%s" menu already exists.' % menu.name)
+            _delete_menu_items(menu)
+        menu.template = menu_data.get('template', menu.template)
+        # A raw save, so that the menu isn't recached before its items are
+        # loaded (and committed).
+        menu.save_base(raw=True)
+        menus.append(menu)
+
+        def build(entries, parent):
+            for position, entry in enumerate(entries):
+                node_type = entry['type']
+                leaf = LEAF_MODELS[node_type]()
+                for field in LEAF_FIELDS[node_type]:
+                    if field in entry:
+                        setattr(leaf, field, entry[field])
+                if node_type == 'page':
+                    leaf.page = pages[entry['page']]
+                leaves[node_type].append(leaf)
+                item = MenuItem(menu=menu, order=entry.get('order', position))
+                item.leaf, item.parent_item = leaf, parent
+                items.append(item)
+                build(entry.get('children', []), item)
+
+        build(menu_data['items'], None)
+
+    for node_type, objects in leaves.items():
+        _allocate_pks(LEAF_MODELS[node_type], objects)
+    _allocate_pks(MenuItem, items)
+    content_types = dict([(node_type, ContentType.objects.get_for_model(model)) \
+        for node_type, model in LEAF_MODELS.items()])
+    for item in items:
+        item.obj_type = content_types[item.leaf.node_type]
+        item.obj_id = item.leaf.pk
+        item.parent_id = item.parent_item and item.parent_item.pk or None
+    # Number the new trees once, now that every item's place is known.
+    fields = compute_tree_fields(items, allocate_tree_ids([], len(items)))
+    for item in items:
+        for field, value in zip(TREE_FIELDS, fields[item.pk]):
+            setattr(item, field, value)
+
+    for node_type, objects in leaves.items():
+        _bulk_insert(LEAF_MODELS[node_type], objects)
+    _bulk_insert(MenuItem, items)
+    return menus
+
+
+def load_menus(data, replace=False):
+    """
+    Create the menus described by ``data``, as returned by ``dump_menus``, in
+    a single transaction, inserting their items and leaf objects in batches
+    and numbering their trees once. Existing menus of the same names are
+    replaced if ``replace`` is True; otherwise they cause a ``ValueError``.
+    Each loaded menu is then recached once. Returns the loaded menus.
+    """
+    from navigation.cache import site_nav
+    menus = _load_menus(data, replace)
+    site_nav.menus_changed()
+    for menu in menus:
+        site_nav.recache(menu.name, 'load_menus')
+    return menus
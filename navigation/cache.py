@@ -1,15 +1,49 @@
-from itertools import chain
+from contextlib import contextmanager
+from hashlib import md5
+import copy
+import cPickle as pickle
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.utils.datastructures import SortedDict
 
+from navigation import instrumentation
+from navigation.app_settings import NAVIGATION_BACKGROUND_THREADS, \
+    NAVIGATION_COMPACT_TREES, NAVIGATION_RECACHE_MODE, \
+    NAVIGATION_SNAPSHOT_MAX_AGE, NAVIGATION_SNAPSHOT_PATH, NAVIGATION_VERSION_CACHE, \
+    NAVIGATION_VERSION_CHECK_INTERVAL, NAVIGATION_VERSION_TIMEOUT
+from navigation.audiences import AUDIENCES, prune_all
+from navigation.background import BackgroundRecacher
+from navigation.compact import CompactNode, freeze
+from navigation.fragments import fragment_cache
 from navigation.models import Menu, MenuFolder, MenuItem, MenuLink, MenuPage
+from navigation.prefetch import attach_page_layouts, prefetch_descendants, prefetch_generics
 
 from pagemanager.models import Page
 from pagemanager.signals import page_edited, page_moved
 
 
+# Regex that matches on leading or trailing slashes.
+outer_slashes = re.compile("(^/|/$)")
+
+# Bump this whenever the layout of the node classes changes, so that snapshots
+# written by an older version are ignored rather than unpickled.
+SNAPSHOT_FORMAT = 3
+
+# The cache key of the shared stamp of the list of menu names, which moves
+# whenever a menu is added, renamed or deleted.
+NAMES_VERSION_KEY = 'navigation:names'
+
+
 class Node(object):
     """
     A base class representing a navigation or page node and providing some 
@@ -32,6 +66,9 @@ class Node(object):
     def __unicode__(self):
         return self.title
 
+    def items(self):
+        return self.children.items()
+
     def keys(self):
         return self.children.keys()
 
@@ -158,147 +195,961 @@ class PageNav(Node):
         return self.status == 'published' and self.show_in_nav
 
 
+class PublishedMenu(object):
+    """
+    A built menu as published by ``SiteNav``: its container, its tree, the
+    variants of the tree pruned for each audience (see
+    ``navigation.audiences``) and the index of the tree's nodes, which maps
+    every ``(node type, pk)`` to the paths (see ``SiteNav._walk``) at which
+    that node can be found. Compact trees are never patched, so their
+    index is only the frozenset of their ``(node type, pk)`` keys. The number
+    of nodes in the tree is counted once, when it is published.
+
+    Neither it nor its trees are ever changed: a regrown or patched menu is
+    published as a new ``PublishedMenu``, with freshly pruned variants and a
+    fresh index.
+    """
+
+    __slots__ = ('container', 'menu_list', 'variants', 'locations', 'node_count')
+
+    def __init__(self, container, menu_list, variants, locations, node_count):
+        self.container = container
+        self.menu_list = menu_list
+        self.variants = variants
+        self.locations = locations
+        self.node_count = node_count
+
+
 class SiteNav(object):
     """
     A dictionary-like container class for all site navigation
     """
     
+    def __contains__(self, key):
+        return key in self.keys()
+
     def __getitem__(self, key):
-        return self.menu_containers.__getitem__(key), self.menu_list.__getitem__(key)
+        published = self._get(key)
+        return published.container, published.menu_list
 
-    def __init__(self):
-        menus = list(Menu.objects.all())
-        self.menu_list = dict(
-            [(menu.name, self.grow(menu)) for menu in menus]
-        )
-        self.menu_containers = dict(
-            [(menu.name, MenuNav(menu)) for menu in menus]
-        )
+    def __init__(self, snapshot_path=NAVIGATION_SNAPSHOT_PATH):
+        # Nothing is loaded here: menu names are fetched the first time they
+        # are needed, and each menu is built (or read from the snapshot) the
+        # first time it is asked for.
+        self.snapshot_path = snapshot_path
+        self._snapshot = None
+        self._names = None
+        self._names_version = None
+        self._names_checked = 0
+        self._lock = threading.RLock()
+        # Per-thread state of deferred (coalesced) recaching.
+        self._deferred = threading.local()
+        # Each menu carries a version stamp, shared between processes through
+        # the cache framework. ``versions`` holds the stamps of the trees
+        # built by this process; a differing shared stamp means that another
+        # process has changed the menu since.
+        self.version_cache = get_cache(NAVIGATION_VERSION_CACHE)
+        self.versions = {}
+        self._version_checks = {}
+        # A reverse index mapping ``(node type, pk)`` to the frozenset of names
+        # of the (built) menus containing that node, so signal handlers can
+        # find the menus affected by a change without crawling every tree.
+        # Kept up to date as menus are published and forgotten; entries are
+        # replaced rather than changed, so they can be read without the lock.
+        self.node_index = {}
+        # For each menu and audience, a trie of URL path segments leading to
+        # the chain of nodes (from the top of the menu's variant for that
+        # audience down) at each URL, along with the ``PublishedMenu`` it was
+        # built from. Built on demand, and built
+        # again whenever the menu has been published since.
+        self._tries = {}
+        # The built menus, as ``PublishedMenu`` objects keyed by menu name. A
+        # changed menu is published by replacing its object, tree, variants
+        # and index together, in a single assignment, so that readers always
+        # see either the complete old or the complete new menu.
+        self._published = {}
+        # A lock per menu name, held while the menu is regrown or patched, so
+        # that changes to a menu are made one at a time and a build that
+        # started earlier can never replace the tree of a later one. Always
+        # taken before ``_lock``.
+        self._rebuild_locks = {}
+        self.recacher = BackgroundRecacher(self._recache, NAVIGATION_BACKGROUND_THREADS)
 
     def __iter__(self):
-        return self.menu_list.__iter__()
+        return iter(self.keys())
 
-    def _get_node_id_sets(self, key):
+    def _ensure(self, key):
         """
-        Returns a dictionary of sets of all node type IDs associated 
-        with a particular nav item tree.
+        Build the menu with the given key if this process hasn't yet, using
+        the snapshot if it holds the menu with the current version stamp.
         """
-        _, menu_list = self[key]
+        if key in self._published:
+            return
+        with self._lock:
+            if key in self._published:
+                return
+            try:
+                menu = Menu.objects.get(name=key)
+            except Menu.DoesNotExist:
+                # Deleted since the names were listed.
+                self._forget(key)
+                raise KeyError(key)
+            if self._snapshot is None:
+                self._snapshot = self.snapshot_path and read_snapshot(self.snapshot_path) or {}
+            container, menu_list, variants, snapshot_version = \
+                self._snapshot.pop(key, (None, None, None, None))
+            # With no shared stamp yet (a cold or per-process version cache),
+            # the snapshot's stamp becomes the shared one, so that every process
+            # can start from the snapshot. Its age is bounded by
+            # ``NAVIGATION_SNAPSHOT_MAX_AGE``.
+            version = self._shared_version(key, snapshot_version)
+            self.versions[key] = version
+            if snapshot_version is None or snapshot_version != version:
+                container, menu_list, variants = MenuNav(menu), self.grow(menu, 'first use'), None
+            self._store(key, container, menu_list, variants)
 
-        def crawl(node, acc):
-            if not node.type in acc:
-                acc[node.type] = set()
-            acc[node.type].add(node.pk)
-            if not node.is_leaf:
-                [crawl(child, acc) for child in node.children.values()]
-            return acc
+    def _get(self, key):
+        """
+        Returns the ``PublishedMenu`` of the menu with the given key, building
+        the menu first if needed.
+        """
+        self._ensure(key)
+        return self._published[key]
 
-        dicts = [crawl(node, {}) for node in menu_list]
-        all_keys = set(chain(*[d.keys() for d in dicts]))
-        all_dicts = [dict([(key, d.get(key, set())) for key in all_keys]) for d in dicts]
-        
-        def merge_dicts(a, b):
-            for key, value in a.iteritems():
-                a[key] = a[key] | b[key]
-            return a
+    def _ensure_all(self):
+        for key in self.keys():
+            try:
+                self._ensure(key)
+            except KeyError:
+                pass
+
+    def _forget(self, key):
+        """
+        Drop everything this process holds about the menu with the given key.
+        """
+        with self._lock:
+            if self._names is not None and key in self._names:
+                self._names.remove(key)
+            published = self._published.pop(key, None)
+            if published is not None:
+                self._reindex(key, published.locations, ())
+            for audience in AUDIENCES:
+                self._tries.pop((key, audience), None)
+            self.versions.pop(key, None)
+            self._version_checks.pop(key, None)
+        fragment_cache.invalidate(key)
+
+    @staticmethod
+    def _version_key(key):
+        return 'navigation:version:%s' % md5(key.encode('utf-8')).hexdigest()
 
-        retval = reduce(merge_dicts, all_dicts)
+    def _shared_version(self, key, candidate=None):
+        """
+        Returns the shared version stamp of the menu with the given key,
+        stamping it with ``candidate`` (or a new stamp) first if it has none.
+        """
+        return self._shared_stamp(self._version_key(key), candidate)
+
+    def _shared_stamp(self, version_key, candidate=None):
+        """
+        Returns the stamp stored under the given cache key, storing
+        ``candidate`` (or a new stamp) there first if there is none.
+
+        The stamp is only added if still missing and then read back, so that
+        processes starting at the same time all settle on the same stamp
+        instead of each publishing (and making the others rebuild) its own.
+        """
+        version = self.version_cache.get(version_key)
+        if version is None:
+            candidate = candidate or uuid.uuid4().hex
+            self.version_cache.add(version_key, candidate, NAVIGATION_VERSION_TIMEOUT)
+            # Caches that don't store anything (e.g. the dummy cache) return
+            # None again.
+            version = self.version_cache.get(version_key) or candidate
+        return version
+
+    def _publish(self, key):
+        """
+        Stamp the menu with the given key with a new shared version, so that
+        other processes know to rebuild it, and return the new version.
+        """
+        version = uuid.uuid4().hex
+        self.version_cache.set(self._version_key(key), version, NAVIGATION_VERSION_TIMEOUT)
+        self.versions[key] = version
+        fragment_cache.invalidate(key)
+        return version
+
+    def _get_node_id_sets(self, key):
+        """
+        Returns a dictionary of sets of all node type IDs associated 
+        with a particular nav item tree.
+        """
+        locations = self._get(key).locations
         # Make sure that all types of items are represented in the returned dictionary,
         # even if it's just an empty set.
-        for required_key in ('page', 'link', 'folder'):
-            if required_key not in retval:
-                retval[required_key] = set([])
+        retval = {'page': set(), 'link': set(), 'folder': set()}
+        for node_type, pk in locations:
+            retval.setdefault(node_type, set()).add(pk)
         return retval
 
     @classmethod
-    def _grow_menu(cls, menu):
+    def _walk(cls, path, node):
         """
-        Given a ``Menu`` instance, recursively construct a tree of ``Menu`` objects
-        using all children of the given ``Menu``.
+        Yields a ``(path, node)`` tuple for the given node and each of its
+        descendants, where a node's path is the tuple of the position of its
+        top-level node in the menu list followed by the keys leading from
+        there down to the node.
         """
-        if isinstance(menu, MenuItem):
-            menu = menu.obj
-        if isinstance(menu, MenuFolder):
-            root = MenuNav(menu)
-            for child in menu.menu_item.get_children():
-                root[child.pk] = cls._grow_menu(child)
-            return root
-        if isinstance(menu, MenuPage):
-            menu.page.html_class_name = menu.html_class_name
-            menu.page.depth = menu.depth
-            return cls._grow_page(menu.page)
-        # MenuLink instances are always terminal.
-        if isinstance(menu, MenuLink) or menu.is_leaf_node():
-            return MenuNav(menu)
-        else:
-            root = MenuNav(menu)
-            for child in menu.get_children():
-                root[child.pk] = cls._grow_menu(child)
+        yield path, node
+        for key, child in node.items():
+            for entry in cls._walk(path + (key,), child):
+                yield entry
+
+    @classmethod
+    def _walk_menu(cls, menu_list):
+        """
+        Yields a ``(path, node)`` tuple for every node of the given tree.
+        """
+        for position, node in enumerate(menu_list):
+            for entry in cls._walk((position,), node):
+                yield entry
+
+    @classmethod
+    def _node_keys(cls, menu_list):
+        """
+        Returns the frozenset of the ``(node type, pk)`` of the nodes of the
+        given tree.
+        """
+        return frozenset([(node.type, node.pk) for path, node in cls._walk_menu(menu_list)])
+
+    @classmethod
+    def _locate(cls, menu_list):
+        """
+        Returns the index of the given tree: a dictionary mapping the
+        ``(node type, pk)`` of each of its nodes to the paths at which that
+        node can be found, which allows subtrees to be replaced.
+        """
+        locations = {}
+        for path, node in cls._walk_menu(menu_list):
+            locations.setdefault((node.type, node.pk), []).append(path)
+        return locations
+
+    @classmethod
+    def _node_at(cls, menu_list, path):
+        """
+        Returns the node at the given path in the given tree.
+        """
+        node = menu_list[path[0]]
+        for key in path[1:]:
+            node = node[key]
+        return node
+
+    @classmethod
+    def _replace(cls, menu_list, path, node):
+        """
+        Returns a copy of the given tree in which the node at the given path
+        is replaced by ``node``, keeping its position among its siblings. Only
+        the nodes leading to it are copied: the rest of the tree is shared with
+        the given one, which is left untouched for the threads reading it.
+        """
+        old_node = cls._node_at(menu_list, path)
+        for attr in ('first', 'last'):
+            if getattr(old_node, attr, False):
+                setattr(node, attr, True)
+        menu_list = list(menu_list)
+        position, keys = path[0], path[1:]
+        if not keys:
+            menu_list[position] = node
+            return menu_list
+        parent = menu_list[position] = copy.copy(menu_list[position])
+        for key in keys[:-1]:
+            parent.children = parent.children.copy()
+            parent = parent.children[key] = copy.copy(parent.children[key])
+        child_key = keys[-1]
+        # Pages are keyed by slug below other pages, but by menu item below
+        # folders (see ``_build``).
+        new_key = isinstance(parent, PageNav) and node.slug or child_key
+        children = SortedDict()
+        for key, child in parent.items():
+            if key == child_key:
+                children[new_key] = node
+            else:
+                children[key] = child
+        parent.children = children
+        return menu_list
+
+    def _trie(self, key, audience):
+        """
+        Returns the URL trie of the menu with the given key, as shown to the
+        given audience. Each level of the trie is a dictionary of path
+        segments to the next level, with the chain of nodes at that URL, if
+        any, stored under the ``None`` key.
+        """
+        published = self._get(key)
+        cached = self._tries.get((key, audience))
+        if cached is not None and cached[0] is published:
+            return cached[1]
+        trie = {}
+
+        def crawl(node, chain):
+            chain = chain + (node,)
+            url = getattr(node, 'url', None)
+            # Only paths on this site can be matched against the request path.
+            if url and url.startswith('/'):
+                level = trie
+                for segment in split_path(url):
+                    level = level.setdefault(segment, {})
+                level.setdefault(None, chain)
+            for child in node.values():
+                crawl(child, chain)
+
+        for node in published.variants[audience]:
+            crawl(node, ())
+        # Stored along with the menu it was built from, so that a trie built
+        # from a menu replaced in the meantime is never used.
+        self._tries[(key, audience)] = (published, trie)
+        return trie
+
+    @classmethod
+    def _build(cls, menu_obj):
+        """
+        Given a ``Menu`` instance, construct its tree of ``MenuNav`` and
+        ``PageNav`` objects with a fixed number of queries, regardless of the
+        size of the menu:
+
+        1. every ``MenuItem`` in the menu's trees;
+        2. one ``in_bulk`` query per leaf content type;
+        3. the root pages of all ``MenuPage`` leaves;
+        4. the descendants of those pages, selected by MPTT range and level;
+        5. whatever ``attach_generics`` needs to attach the layouts of all
+           those pages at once.
+
+        The tree is then assembled in memory.
+        """
+        root_trees = MenuItem.objects.filter(menu=menu_obj, level=0).values('tree_id')
+        items = list(MenuItem.objects.filter(tree_id__in=root_trees).order_by('tree_id', 'lft'))
+
+        # Resolve the ``obj`` generic foreign keys, one query per content type.
+        prefetch_generics(items)
+        item_children = {}
+        for item in items:
+            item_children.setdefault(item.parent_id, []).append(item)
+
+        # Load the page trees hanging off of any ``MenuPage`` leaves.
+        menu_pages = [item.obj for item in items if isinstance(item.obj, MenuPage)]
+        root_pages, page_children = cls._load_pages(
+            [(mp.page_id, mp.depth) for mp in menu_pages]
+        )
+
+        def assemble(item):
+            leaf = item.obj
+            if isinstance(leaf, MenuPage):
+                page = root_pages[leaf.page_id]
+                page.html_class_name = leaf.html_class_name
+                return cls._assemble_page(page, page_children, leaf.depth)
+            root = MenuNav(leaf)
+            # MenuLink instances are always terminal.
+            if isinstance(leaf, MenuFolder):
+                for child in item_children.get(item.pk, []):
+                    root[child.pk] = assemble(child)
             return root
 
+        return [assemble(item) for item in items if item.menu_id == menu_obj.pk \
+            and item.parent_id is None]
+
     @classmethod
-    def _grow_page(cls, page):
+    def _load_pages(cls, roots):
+        """
+        Given a list of ``(page id, depth)`` tuples, load the root pages and
+        their descendants down to ``depth`` levels below them, all with
+        their layouts attached. Returns a dictionary of root pages keyed by
+        primary key and a dictionary of child page lists keyed by parent id.
         """
-        Given a ``Page`` instance recursively construct a tree of ``Page`` objects
-        using all children of the given ``Page``.
+        root_pages = Page.objects.in_bulk(list(set(page_id for page_id, _ in roots)))
+        descendants = prefetch_descendants([(root_pages[page_id], depth) \
+            for page_id, depth in set(roots) if page_id in root_pages], layouts=False)
+        page_children = {}
+        loaded = set()
+        for pages in descendants.values():
+            for page in pages:
+                if page.pk not in loaded:
+                    loaded.add(page.pk)
+                    page_children.setdefault(page.parent_id, []).append(page)
+        attach_page_layouts(root_pages.values() + \
+            [page for pages in page_children.values() for page in pages])
+        return root_pages, page_children
+
+    @classmethod
+    def _assemble_page(cls, page, page_children, depth=None):
         """
+        Construct a tree of ``PageNav`` objects from the given ``Page`` and a
+        dictionary of preloaded child page lists keyed by parent id, down to
+        ``depth`` levels below the page (or as deep as the preloaded pages go
+        if ``depth`` is None). Each node keeps the number of levels left below
+        it in ``limit_depth_to``.
+        """
+        page.depth = depth
         root = PageNav(page)
-        if page.is_leaf_node() or root.limit_depth_to == 0:
+        if depth == 0:
             return root
-        for child in page.get_children():
-            if root.limit_depth_to is None:
-                child.limit_depth_to = None
-            else:
-                child.limit_depth_to = root.limit_depth_to - 1
-            root[child.slug] = cls._grow_page(child)
+        if depth is not None:
+            depth -= 1
+        for child in page_children.get(page.pk, []):
+            root[child.slug] = cls._assemble_page(child, page_children, depth)
         return root
 
+    def dump(self, path):
+        """
+        Write a snapshot of every menu tree, along with its audience variants
+        and version stamp, to the file at the given path.
+        """
+        self._ensure_all()
+        menus = {}
+        for key in self.keys():
+            published = self._published.get(key)
+            if published is not None:
+                menus[key] = (published.container, published.menu_list, published.variants, \
+                    self.versions.get(key))
+        write_snapshot(path, menus)
+
+    def get_trail(self, key, path, audience='anonymous'):
+        """
+        Returns the list of nodes, from the top of the menu with the given key
+        down, leading to the node whose URL is the longest prefix of the given
+        path, or an empty list if no node matches. Only the nodes shown to the
+        given audience are considered.
+        """
+        level = self._trie(key, audience)
+        trail = level.get(None, ())
+        for segment in split_path(path):
+            if segment not in level:
+                break
+            level = level[segment]
+            trail = level.get(None, trail)
+        return list(trail)
+
+    def get_active_node(self, key, path, audience='anonymous'):
+        """
+        Returns the node of the menu with the given key whose URL is the given
+        path and which is shown to the given audience, or None.
+        """
+        level = self._trie(key, audience)
+        for segment in split_path(path):
+            level = level.get(segment)
+            if level is None:
+                return None
+        trail = level.get(None)
+        return trail and trail[-1] or None
+
+    def get_breadcrumbs(self, key, path, audience='anonymous'):
+        """
+        Returns a list of ``(title, url)`` tuples for the nodes of the active
+        trail of the given path in the menu with the given key, as shown to
+        the given audience. Folders have no URL.
+        """
+        return [(node.title, getattr(node, 'url', None)) for node in self.get_trail(key, path, audience)]
+
+    def get_variant(self, key, audience):
+        """
+        Returns the ``(container, menu list)`` tuple of the menu with the given
+        key, pruned of the nodes hidden from the given audience.
+        """
+        published = self._get(key)
+        return published.container, published.variants[audience]
+
+    def get_version(self, key):
+        """
+        Returns the current shared version stamp of the menu with the given
+        key, whether or not this process has built it.
+        """
+        # If the stamp has expired or been evicted, put ours back.
+        return self._shared_version(key, self.versions.get(key))
+
     def get_items_for_type(self, t):
         assert t in ('page', 'link', 'folder'), "Incorrect type."
         return [(key, site_nav._get_node_id_sets(key).get(t, [])) for key in site_nav.keys()]
 
     @classmethod
-    def grow(cls, menu_obj):
+    def grow(cls, menu_obj, trigger=None):
         assert isinstance(menu_obj, Menu), "You must provide a Menu object."
-        menu_children = menu_obj.menuitem_set.filter(level=0)
-
-        def climb(item):
-            if isinstance(item, Page):
-                return cls._grow_page(item)
-            elif isinstance(item, MenuItem):
-                return cls._grow_menu(item.obj)
-            else:
-                return cls._grow_menu(item)
-
-        menu_children = map(climb, menu_children)
+        started = instrumentation.start('grow')
+        menu_children = cls._build(menu_obj)
         if menu_children:
             menu_children[0].first = True
             menu_children[-1].last = True
+        if started is not None:
+            instrumentation.finish('grow', started, cls, menu=menu_obj.name, \
+                node_count=cls._count_nodes(menu_children), trigger=trigger)
         return menu_children
 
+    @classmethod
+    def _count_nodes(cls, menu_list):
+        return len(list(cls._walk_menu(menu_list)))
+
+    def node_count(self, key):
+        """
+        Returns the number of nodes in the menu with the given key.
+        """
+        return self._get(key).node_count
+
     def keys(self):
-        return self.menu_list.keys()
+        """
+        Returns the names of all menus. The list is fetched again whenever a
+        menu has been added, renamed or deleted by any process, as told by a
+        shared stamp checked at most every ``NAVIGATION_VERSION_CHECK_INTERVAL``
+        seconds.
+        """
+        now = time.time()
+        if self._names is not None and \
+            now - self._names_checked >= NAVIGATION_VERSION_CHECK_INTERVAL:
+            self._names_checked = now
+            if self.version_cache.get(NAMES_VERSION_KEY) != self._names_version:
+                self._names = None
+        if self._names is None:
+            # Read the stamp first, so that changes made while the names are
+            # being fetched move it again.
+            self._names_version = self._shared_stamp(NAMES_VERSION_KEY)
+            self._names_checked = now
+            names = list(Menu.objects.values_list('name', flat=True))
+            for key in set(self._published) - set(names):
+                self._forget(key)
+            self._names = names
+        return list(self._names)
 
-    def recache(self, key):
+    def menus_changed(self):
         """
-        Recache the menu tree with the given key.
+        Tell every process that menus have been added, renamed or deleted, so
+        that they list the menu names again.
+        """
+        self._names_version = uuid.uuid4().hex
+        self.version_cache.set(NAMES_VERSION_KEY, self._names_version, NAVIGATION_VERSION_TIMEOUT)
+        self._names = None
+
+    def remove(self, key):
+        """
+        Forget the menu with the given key, which has been deleted, in this
+        and every other process.
+        """
+        self.version_cache.delete(self._version_key(key))
+        self.menus_changed()
+        self._forget(key)
+
+    def menus_containing(self, node_type, pk):
         """
+        Returns the set of names of the menus that contain the node of the
+        given type ('page', 'link' or 'folder') and primary key.
+
+        The menus this process has built are looked up in ``node_index``; the
+        others are found with a few queries rather than built, so that changes
+        made from processes that don't render menus (e.g. task workers) are
+        stamped on every menu they affect without building any.
+        """
+        names = set(self.node_index.get((node_type, pk), ()))
+        if set(self.keys()) - set(self._published):
+            names |= set(self._stored_menus_containing(node_type, pk)) - set(self._published)
+        return names
+
+    @classmethod
+    def _stored_menus_containing(cls, node_type, pk):
+        """
+        Returns the names of the menus whose stored items place the node of the
+        given type and primary key in their tree, as ``_build`` would.
+        """
+        if node_type == 'page':
+            try:
+                page = Page.objects.get(pk=pk)
+            except Page.DoesNotExist:
+                return []
+            # Menu pages show their page and its descendants down to ``depth``
+            # levels below it.
+            ancestors = Page.objects.filter(tree_id=page.tree_id, lft__lte=page.lft, \
+                rght__gte=page.rght)
+            leaf_ids = [leaf_id for leaf_id, depth, level in MenuPage.objects.filter( \
+                page__in=ancestors).values_list('pk', 'depth', 'page__level') \
+                if page.level - level <= depth]
+            model = MenuPage
+        else:
+            leaf_ids = [pk]
+            model = {'folder': MenuFolder, 'link': MenuLink}[node_type]
+        trees = MenuItem.objects.filter(obj_type=ContentType.objects.get_for_model(model), \
+            obj_id__in=leaf_ids).values('tree_id')
+        return Menu.objects.filter(menuitem__tree_id__in=trees, menuitem__level=0) \
+            .values_list('name', flat=True).distinct()
+
+    def _reindex(self, key, old_node_keys, new_node_keys):
+        """
+        Update the reverse index entries of the menu with the given key, from
+        the given node keys it used to contain to those it contains now. Must
+        be called with ``_lock`` held.
+        """
+        index = self.node_index
+        key_set = frozenset([key])
+        new_node_keys = set(new_node_keys)
+        for node_key in old_node_keys:
+            if node_key not in new_node_keys:
+                remaining = index.get(node_key, key_set) - key_set
+                if remaining:
+                    index[node_key] = remaining
+                else:
+                    index.pop(node_key, None)
+        for node_key in new_node_keys:
+            names = index.get(node_key, frozenset())
+            if key not in names:
+                index[node_key] = names | key_set
+
+    def recache(self, key, trigger=None):
+        """
+        Recache the menu tree with the given key. ``trigger`` optionally names
+        the cause of the recache, for instrumentation.
+
+        While recaching is being coalesced, the menu is only marked as dirty,
+        to be recached once when the pending recaches are flushed. With
+        ``NAVIGATION_RECACHE_MODE = 'background'``, the menu is rebuilt on a
+        background thread and this returns immediately; until the new tree is
+        swapped in, readers keep getting the old one.
+        """
+        if self._defer(key, trigger):
+            return
+        self._dispatch(key, trigger)
+
+    def _dispatch(self, key, trigger=None):
+        if NAVIGATION_RECACHE_MODE == 'background':
+            self.recacher.submit(key, trigger)
+        else:
+            self._recache(key, trigger)
+
+    def _recache(self, key, trigger=None):
+        if key not in self._published:
+            # This process hasn't built the menu, so there is nothing to
+            # rebuild here; the processes that have only need to know.
+            self._publish(key)
+            return
+        started = instrumentation.start('recache')
+        self._regrow(key, trigger)
+        self._publish(key)
+        self._recached(key, started, trigger)
+
+    def _recached(self, key, started, trigger):
+        if started is not None:
+            instrumentation.finish('recache', started, self.__class__, menu=key, \
+                node_count=self.node_count(key), trigger=trigger)
+
+    def _rebuild_lock(self, key):
+        """
+        Returns the lock held while the menu with the given key is regrown or
+        patched.
+        """
+        with self._lock:
+            return self._rebuild_locks.setdefault(key, threading.Lock())
+
+    def _regrow(self, key, trigger=None, blocking=True):
+        """
+        Grow the menu with the given key again and publish it, once any other
+        rebuild of the menu is done. Unless ``blocking`` is True, gives up and
+        returns False if the menu is being rebuilt already.
+        """
+        lock = self._rebuild_lock(key)
+        if not lock.acquire(blocking):
+            return False
         try:
-            menu_item, _ = self[key]
-            menu = Menu.objects.get(pk=menu_item.pk)
-        except KeyError:
-            menu = Menu.objects.get(name=key)
-        self.menu_list[key] = self.grow(menu)
+            try:
+                menu = Menu.objects.get(pk=self._published[key].container.pk)
+            except KeyError:
+                menu = Menu.objects.get(name=key)
+            # The new tree is built off to the side, and only swapped in once
+            # it is complete.
+            menu_list = self.grow(menu, trigger)
+            with self._lock:
+                if self._names is not None and key not in self._names:
+                    self._names.append(key)
+                self._store(key, MenuNav(menu), menu_list)
+        finally:
+            lock.release()
+        return True
+
+    def _store(self, key, container, menu_list, variants=None):
+        """
+        Index the given tree and publish it, along with its audience variants
+        (pruned from it unless given), as the menu with the given key, frozen
+        into the compact format if ``NAVIGATION_COMPACT_TREES`` is set. Must be
+        called with ``_lock`` held.
+        """
+        if NAVIGATION_COMPACT_TREES and menu_list and not isinstance(menu_list[0], CompactNode):
+            # Only the full tree is frozen; its variants are pruned from the
+            # frozen tree and share its columns.
+            menu_list, variants = freeze(menu_list), None
+        if variants is None:
+            variants = prune_all(menu_list)
+        if NAVIGATION_COMPACT_TREES:
+            locations = self._node_keys(menu_list)
+            node_count = self._count_nodes(menu_list)
+        else:
+            locations = self._locate(menu_list)
+            node_count = sum([len(found) for found in locations.values()])
+        previous = self._published.get(key)
+        self._reindex(key, previous is not None and previous.locations or (), locations)
+        self._published[key] = PublishedMenu(container, menu_list, variants, locations, node_count)
+
+    @property
+    def menu_containers(self):
+        # Menus are built lazily, so build them all first.
+        self._ensure_all()
+        return dict([(key, menu.container) for key, menu in self._published.items()])
+
+    @property
+    def menu_list(self):
+        self._ensure_all()
+        return dict([(key, menu.menu_list) for key, menu in self._published.items()])
 
-    def recache_all(self):
+    def _only_built(self, nav_names, trigger=None):
+        """
+        Recache those of the given menus that this process hasn't built, which
+        only moves their stamps, and return the others.
+        """
+        built = []
+        for nav_name in nav_names:
+            if nav_name in self._published:
+                built.append(nav_name)
+            else:
+                self.recache(nav_name, trigger)
+        return built
+
+    def recache_node(self, obj, trigger=None):
+        """
+        Update every ``MenuNav`` representing the given ``MenuFolder`` or
+        ``MenuLink``, leaving its children untouched. Returns the set of names
+        of the menus that were updated.
+        """
+        updated = MenuNav(obj)
+        nav_names = self.menus_containing(updated.type, obj.pk)
+        if NAVIGATION_COMPACT_TREES or NAVIGATION_RECACHE_MODE == 'background' \
+            or self.is_deferring():
+            # Compact trees are read-only, background recaches keep the work
+            # out of the current thread, and coalesced recaches rebuild whole
+            # menus anyway.
+            for nav_name in nav_names:
+                self.recache(nav_name, trigger)
+            return nav_names
+        started = instrumentation.start('recache')
+        built = self._only_built(nav_names, trigger)
+        for nav_name in built:
+            with self._rebuild_lock(nav_name):
+                published = self._get(nav_name)
+                menu_list = published.menu_list
+                for path in published.locations.get((updated.type, obj.pk), ()):
+                    node = copy.copy(self._node_at(menu_list, path))
+                    for attr in ('html_class_name', 'title', 'url'):
+                        setattr(node, attr, getattr(updated, attr))
+                    menu_list = self._replace(menu_list, path, node)
+                with self._lock:
+                    self._store(nav_name, published.container, menu_list)
+            self._publish(nav_name)
+        for nav_name in built:
+            self._recached(nav_name, started, trigger)
+        return nav_names
+
+    def recache_page(self, page, trigger=None):
+        """
+        Regrow every ``PageNav`` subtree rooted at the given ``Page``, without
+        rebuilding the rest of the menus containing it. Returns the set of
+        names of the menus that were updated.
+        """
+        nav_names = self.menus_containing('page', page.pk)
+        if NAVIGATION_COMPACT_TREES or NAVIGATION_RECACHE_MODE == 'background' \
+            or self.is_deferring():
+            # Compact trees are read-only, background recaches keep the work
+            # out of the current thread, and coalesced recaches rebuild whole
+            # menus anyway.
+            for nav_name in nav_names:
+                self.recache(nav_name, trigger)
+            return nav_names
+        started = instrumentation.start('recache')
+        built = self._only_built(nav_names, trigger)
+        depths = set()
+        for nav_name in built:
+            published = self._get(nav_name)
+            for path in published.locations.get(('page', page.pk), ()):
+                depths.add(self._node_at(published.menu_list, path).limit_depth_to)
+        if not depths:
+            return nav_names
+        root_pages, page_children = self._load_pages([(page.pk, depth) for depth in depths])
+        if page.pk not in root_pages:
+            # The page is gone; rebuild the affected menus from scratch.
+            for nav_name in built:
+                self.recache(nav_name, trigger)
+            return nav_names
+        fresh_page = root_pages[page.pk]
+        stale = set()
+        for nav_name in built:
+            with self._rebuild_lock(nav_name):
+                published = self._get(nav_name)
+                menu_list = published.menu_list
+                for path in published.locations.get(('page', page.pk), ()):
+                    node = self._node_at(menu_list, path)
+                    if node.limit_depth_to not in depths:
+                        # The menu changed since the pages were loaded.
+                        stale.add(nav_name)
+                        break
+                    fresh_page.html_class_name = node.html_class_name
+                    menu_list = self._replace(menu_list, path,
+                        self._assemble_page(fresh_page, page_children, node.limit_depth_to))
+                else:
+                    with self._lock:
+                        self._store(nav_name, published.container, menu_list)
+        for nav_name in built:
+            if nav_name in stale:
+                self.recache(nav_name, trigger)
+            else:
+                self._publish(nav_name)
+                self._recached(nav_name, started, trigger)
+        return nav_names
+
+    def _deferred_state(self):
+        state = self._deferred
+        if not hasattr(state, 'dirty'):
+            state.dirty = SortedDict()
+            state.depth = 0
+            state.in_request = False
+        return state
+
+    def is_deferring(self):
+        """
+        Returns True if recaches in the current thread are being coalesced.
+        """
+        state = self._deferred_state()
+        return state.depth > 0 or \
+            (state.in_request and NAVIGATION_RECACHE_MODE in ('coalesce', 'background'))
+
+    def _defer(self, key, trigger):
+        """
+        Mark the menu with the given key as dirty if recaches are being
+        coalesced, and return whether it was.
+        """
+        if not self.is_deferring():
+            return False
+        state = self._deferred_state()
+        if key not in state.dirty:
+            state.dirty[key] = trigger
+        return True
+
+    @contextmanager
+    def coalesced(self):
+        """
+        A context manager within which recaches are coalesced, and after
+        which each dirty menu is recached once (or, when coalescing the
+        current request, once the request is over).
+        """
+        state = self._deferred_state()
+        state.depth += 1
+        try:
+            yield
+        finally:
+            state.depth -= 1
+            if not state.depth and not (state.in_request and \
+                NAVIGATION_RECACHE_MODE in ('coalesce', 'background')):
+                self.flush()
+
+    def begin_request(self):
+        self._deferred_state().in_request = True
+
+    def end_request(self):
+        state = self._deferred_state()
+        state.in_request = False
+        if not state.depth:
+            self.flush()
+
+    def flush(self):
+        """
+        Recache, once each, the menus marked as dirty in the current thread.
+        """
+        state = self._deferred_state()
+        dirty, state.dirty = state.dirty, SortedDict()
+        for key, trigger in dirty.items():
+            self._dispatch(key, trigger)
+
+    def recache_all(self, trigger=None):
         """
         Recache all menu trees.
         """
         for key in self.keys():
-            self.recache(key)
+            self.recache(key, trigger)
+
+    def sync(self, key):
+        """
+        Make sure the menu with the given key is as recent as the one last
+        built by any process, regrowing it if its shared version stamp has
+        moved. Checks are throttled by ``NAVIGATION_VERSION_CHECK_INTERVAL``.
+        """
+        if key not in self._published:
+            # Not built yet; it will be built from the current version.
+            return
+        now = time.time()
+        if now - self._version_checks.get(key, 0) < NAVIGATION_VERSION_CHECK_INTERVAL:
+            return
+        self._version_checks[key] = now
+        # If the stamp has expired or been evicted, put ours back.
+        shared = self._shared_version(key, self.versions.get(key))
+        if shared == self.versions.get(key):
+            return
+        if not self._regrow(key, 'version', blocking=False):
+            # Another thread is regrowing or patching it; keep serving the
+            # current tree in the meantime.
+            return
+        self.versions[key] = shared
+        fragment_cache.invalidate(key)
 
     def values(self):
-        return self.menu_list.values()
+        return [self[key][1] for key in self.keys()]
+
+
+def split_path(path):
+    """
+    Split a URL path into a list of its segments, ignoring outer slashes.
+    """
+    return outer_slashes.sub("", path).split("/")
+
+
+def read_snapshot(path):
+    """
+    Returns the dictionary of ``(container, menu list, variants, version)``
+    tuples, keyed by menu name, stored in the snapshot file at the given path, or an empty
+    dictionary if the file is missing, unreadable, of another format or older
+    than ``NAVIGATION_SNAPSHOT_MAX_AGE``.
+    """
+    try:
+        with open(path, 'rb') as snapshot_file:
+            snapshot = pickle.loads(zlib.decompress(snapshot_file.read()))
+    except (IOError, OSError, EOFError, zlib.error, pickle.UnpicklingError, \
+        AttributeError, ImportError, ValueError):
+        return {}
+    if not isinstance(snapshot, dict) or snapshot.get('format') != SNAPSHOT_FORMAT:
+        return {}
+    if NAVIGATION_SNAPSHOT_MAX_AGE is not None and \
+        time.time() - snapshot.get('created', 0) > NAVIGATION_SNAPSHOT_MAX_AGE:
+        return {}
+    return snapshot.get('menus', {})
+
+
+def write_snapshot(path, menus):
+    """
+    Atomically write the given dictionary of ``(container, menu list,
+    version)`` tuples, keyed by menu name, to a snapshot file at the given path.
+    """
+    snapshot = zlib.compress(pickle.dumps({
+        'format': SNAPSHOT_FORMAT,
+        'created': time.time(),
+        'menus': menus,
+    }, pickle.HIGHEST_PROTOCOL))
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as snapshot_file:
+            snapshot_file.write(snapshot)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 
 # This global object represents the default navigation set for the site.
@@ -314,23 +1165,66 @@ site_nav = SiteNav()
 
 @receiver(post_save, sender=MenuFolder)
 def folder_save(sender, instance, raw, using, **kwargs):
-    items = site_nav.get_items_for_type('folder')
-    for nav_key, id_set in items:
-        if instance.pk in id_set:
-            site_nav.recache(nav_key)
+    # Raw saves come from fixtures and bulk loads, which recache once they're done.
+    if not raw:
+        site_nav.recache_node(instance, 'folder_save')
 
 
 @receiver(post_save, sender=MenuLink)
 def link_save(sender, instance, raw, using, **kwargs):
-    items = site_nav.get_items_for_type('link')
-    for nav_key, id_set in items:
-        if instance.pk in id_set:
-            site_nav.recache(nav_key)
+    if not raw:
+        site_nav.recache_node(instance, 'link_save')
+
+
+@receiver(post_save, sender=MenuPage)
+def menu_page_save(sender, instance, raw, using, **kwargs):
+    """
+    A menu page's page, depth and class name shape the subtree it adds to its
+    menus, but saving it changes none of its menu items (``BaseMenuLeaf.save``
+    only adds one outside any menu), so its menus are recached here.
+    """
+    if raw:
+        return
+    items = instance.menu_items.exclude(menu=None).select_related('menu')
+    for nav_name in set([item.menu.name for item in items]):
+        site_nav.recache(nav_name, 'menu_page_save')
+
+
+@receiver(post_save, sender=MenuItem)
+@receiver(post_delete, sender=MenuItem)
+def menu_item_changed(sender, instance, **kwargs):
+    """
+    Items being added to, moved within or removed from a menu change its
+    structure, so the whole menu is recached.
+
+    Deleting an item or a leaf through the model's ``delete`` cascades to
+    every item below it; those deletions are coalesced (see
+    ``MenuItem.delete``), so that the menu is recached once, not once per
+    deleted item.
+    """
+    if instance.menu_id is None or kwargs.get('raw'):
+        return
+    try:
+        menu = instance.menu
+    except Menu.DoesNotExist:
+        # The menu itself is being deleted.
+        return
+    site_nav.recache(menu.name, 'menu_item_changed')
 
 
 @receiver(post_save, sender=Menu)
 def menu_save(sender, instance, raw, using, **kwargs):
-    site_nav.recache(instance.name)
+    # Raw saves come from fixtures and bulk loads, which recache once they're done.
+    if raw:
+        return
+    # The menu may be new or renamed.
+    site_nav.menus_changed()
+    site_nav.recache(instance.name, 'menu_save')
+
+
+@receiver(post_delete, sender=Menu)
+def menu_delete(sender, instance, using, **kwargs):
+    site_nav.remove(instance.name)
 
 
 @receiver(post_delete, sender=Page)
@@ -339,10 +1233,8 @@ def page_deleted(sender, instance, using, **kwargs):
     # there is no need to recache.
     if not instance.is_published() or instance.page_layout.show_in_nav:
         return
-    for nav_name in site_nav.keys():
-        nav_page_ids = site_nav._get_node_id_sets(nav_name)['page']
-        if instance.pk in nav_page_ids:
-            site_nav.recache(nav_name)
+    for nav_name in site_nav.menus_containing('page', instance.pk):
+        site_nav.recache(nav_name, 'page_deleted')
 
 
 @receiver(page_edited)
@@ -358,11 +1250,8 @@ def menu_item_edited(sender, page, created=False, **kwargs):
             # If the item is newly-created, it won't be in the cache yet, so
             # it's parent will be used instead.
             page = page.parent
-    for nav_name in site_nav.keys():
-        nav_page_ids = site_nav._get_node_id_sets(nav_name)['page']
-        if page.pk in nav_page_ids:
-            _, pages = site_nav[nav_name]
-            site_nav.recache(nav_name)
+    if page is not None:
+        site_nav.recache_page(page, 'menu_item_edited')
 
 
 @receiver(page_moved)
@@ -373,7 +1262,8 @@ def menu_item_moved(sender, branch_ids, **kwargs):
     The branch IDs passed in here represent page IDs which may have been affected
     by the move. Find all Nav items that also contain these IDs.
     """
-    for nav_name in site_nav.keys():
-        nav_page_ids = site_nav._get_node_id_sets(nav_name)['page']
-        if nav_page_ids.intersection(branch_ids):
-            site_nav.recache(nav_name)
+    nav_names = set()
+    for page_id in branch_ids:
+        nav_names |= site_nav.menus_containing('page', page_id)
+    for nav_name in nav_names:
+        site_nav.recache(nav_name, 'menu_item_moved')
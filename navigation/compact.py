@@ -0,0 +1,192 @@
+"""
+A frozen, compact representation of built navigation trees.
+
+A ``CompactTree`` stores a whole menu as a handful of flat tuples, one per
+node field, with the nodes in pre-order and each node's subtree ending at the
+index stored in ``ends``. Repeated strings are shared. ``CompactNode`` objects
+are lightweight views onto a node of such a tree that provide the same
+dictionary-like API as ``Node``.
+
+A tree can be pruned of some of its subtrees (see ``navigation.audiences``)
+without being copied: the pruned tree shares the columns of the original and
+only records which subtrees were cut.
+"""
+
+FIELDS = (
+    'type', 'key', 'pk', 'slug', 'title', 'url', 'html_class_name', 'template',
+    'status', 'visibility', 'show_in_nav', 'show_children', 'limit_depth_to',
+    'first', 'last',
+)
+
+
+class CompactTree(object):
+    """
+    A menu's nodes in pre-order, as one tuple per field in ``FIELDS`` plus
+    the ``ends`` tuple of the index just past each node's subtree.
+
+    Pruned trees also hold the set of indexes of the nodes whose subtrees were
+    cut from the tree, and the ``(first, last)`` flags of the top-level nodes
+    whose flags changed.
+    """
+
+    __slots__ = ('columns', 'ends', 'roots', 'cut', 'flags')
+
+    def __init__(self, menu_list):
+        strings = {}
+
+        def share(value):
+            if isinstance(value, basestring):
+                return strings.setdefault(value, value)
+            return value
+
+        columns = [[] for field in FIELDS]
+        ends = []
+
+        def add(key, node):
+            index = len(ends)
+            ends.append(None)
+            for column, field in zip(columns, FIELDS):
+                if field == 'key':
+                    column.append(share(key))
+                else:
+                    column.append(share(getattr(node, field, None)))
+            for child_key, child in node.items():
+                add(child_key, child)
+            ends[index] = len(ends)
+            return index
+
+        roots = [add(position, node) for position, node in enumerate(menu_list)]
+        self.columns = tuple(tuple(column) for column in columns)
+        self.ends = tuple(ends)
+        self.roots = tuple(roots)
+        self.cut = frozenset()
+        self.flags = {}
+
+    def prune(self, hidden):
+        """
+        Returns a copy of this tree without the subtrees of the nodes at the
+        given indexes, sharing this tree's columns.
+        """
+        pruned = CompactTree.__new__(CompactTree)
+        pruned.columns = self.columns
+        pruned.ends = self.ends
+        pruned.cut = self.cut.union(hidden)
+        pruned.roots = tuple([index for index in self.roots if index not in pruned.cut])
+        # Top-level nodes are flagged as first and last, which pruning can
+        # change.
+        pruned.flags = {}
+        for position, index in enumerate(pruned.roots):
+            flags = (position == 0, position == len(pruned.roots) - 1)
+            if (bool(self.columns[FIRST][index]), bool(self.columns[LAST][index])) != flags:
+                pruned.flags[index] = flags
+        return pruned
+
+    def nodes(self):
+        """
+        Returns views onto the top-level nodes of the menu.
+        """
+        return [CompactNode(self, index) for index in self.roots]
+
+    def children(self, index):
+        """
+        Returns the indexes of the children of the node at the given index.
+        """
+        child = index + 1
+        end = self.ends[index]
+        children = []
+        while child < end:
+            if child not in self.cut:
+                children.append(child)
+            child = self.ends[child]
+        return children
+
+
+class CompactNode(object):
+    """
+    A view onto a single node of a ``CompactTree``.
+    """
+
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, CompactNode) and self.tree is other.tree \
+            and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __getitem__(self, key):
+        for child in self.tree.children(self.index):
+            if self.tree.columns[KEY][child] == key:
+                return CompactNode(self.tree, child)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return '<CompactNode %s "%s">' % (
+            self.type, (self.title or u'').encode("ascii", "ignore")
+        )
+
+    def __unicode__(self):
+        return self.title
+
+    def items(self):
+        keys = self.tree.columns[KEY]
+        return [(keys[child], CompactNode(self.tree, child)) \
+            for child in self.tree.children(self.index)]
+
+    def keys(self):
+        keys = self.tree.columns[KEY]
+        return [keys[child] for child in self.tree.children(self.index)]
+
+    def values(self):
+        return [CompactNode(self.tree, child) for child in self.tree.children(self.index)]
+
+    @property
+    def is_leaf(self):
+        return self.tree.ends[self.index] == self.index + 1 or not self.tree.children(self.index)
+
+    @property
+    def is_public(self):
+        return self.type != 'page' or self.visibility == 'public'
+
+    @property
+    def is_published(self):
+        return self.type != 'page' or (self.status == 'published' and self.show_in_nav)
+
+
+def _field(position):
+    return property(lambda self: self.tree.columns[position][self.index])
+
+def _flag(position, flag):
+    def get(self):
+        flags = self.tree.flags.get(self.index)
+        if flags is not None:
+            return flags[flag]
+        return self.tree.columns[position][self.index]
+    return property(get)
+
+for _position, _name in enumerate(FIELDS):
+    setattr(CompactNode, _name, _field(_position))
+KEY = FIELDS.index('key')
+FIRST = FIELDS.index('first')
+LAST = FIELDS.index('last')
+CompactNode.first = _flag(FIRST, 0)
+CompactNode.last = _flag(LAST, 1)
+
+
+def freeze(menu_list):
+    """
+    Returns a list of ``CompactNode`` views onto a frozen copy of the given
+    list of top-level ``Node`` objects.
+    """
+    return CompactTree(menu_list).nodes()
@@ -0,0 +1,141 @@
+"""
+An in-memory cache of the HTML rendered by ``fast_menu``.
+
+On a given menu, the output of ``fast_menu`` only depends on the part of the
+path that ``render_node`` actually looks at, on the renderer and on the
+audience of the request. Fragments are cached under those, along with the
+menu's version, in a bounded LRU cache that ``SiteNav`` clears for a menu
+whenever that menu changes.
+"""
+import threading
+
+from django.utils.datastructures import SortedDict
+
+from navigation.app_settings import NAVIGATION_FRAGMENT_CACHE_SIZE
+from navigation.compact import CompactNode
+
+
+# Markers used in path keys for a path that ends at a given depth, for a path
+# segment that matches none of the nodes at its depth, and for a path that
+# continues past the deepest open nodes.
+# They are tuples so they can never be mistaken for a slug.
+END = ('end',)
+NO_MATCH = ('no-match',)
+MORE = ('more',)
+
+
+class FragmentCache(object):
+    """
+    A thread-safe, bounded, least-recently-used cache of rendered menus,
+    keeping count of its hits and misses.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Ordered from least to most recently used.
+        self._entries = SortedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the fragment cached under the given key, or None.
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                del self._entries[self._entries.keyOrder[0]]
+
+    def invalidate(self, nav_name):
+        """
+        Drop every fragment of the menu with the given name.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == nav_name]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+        }
+
+
+def same_node(node, other):
+    """
+    Returns True if both arguments are the same node of a built tree. Compact
+    nodes are views created on access, so they are compared by position.
+    """
+    if isinstance(node, CompactNode):
+        return node == other
+    return node is other
+
+
+def path_key(menu_list, path, max_depth=None, trail_only=False, trail=None, active_node=None):
+    """
+    Reduce a list of path slugs to the parts that affect how ``render_node``
+    renders the given menu, with the given ``max_depth``, ``trail_only``,
+    ``trail`` and ``active_node`` options: at each depth that is rendered, the
+    slug if it matches a node at that depth (or a marker if it doesn't or if
+    the path has ended), the nodes of the trail and the position of the active
+    node at that depth if a trail is given, and whether the path continues
+    past the deepest open nodes.
+    """
+    key = []
+    nodes = menu_list
+    depth = 0
+    while nodes:
+        if depth < len(path):
+            segment = path[depth]
+            slugs = set(getattr(node, 'slug', None) for node in nodes)
+            key.append(segment in slugs and segment or NO_MATCH)
+        else:
+            segment = None
+            key.append(END)
+        folders_open = not trail_only and (max_depth is None or depth + 1 < max_depth)
+        if trail is None:
+            opened = [node for node in nodes if (folders_open and node.type == "folder") or \
+                (segment is not None and getattr(node, 'slug', None) == segment)]
+        else:
+            on_trail = [(node.type, node.pk) for node in nodes if (node.type, node.pk) in trail]
+            key.append(tuple(on_trail))
+            key.append(tuple([position for position, node in enumerate(nodes) \
+                if active_node is not None and same_node(node, active_node)]))
+            opened = [node for node in nodes if (folders_open and node.type == "folder") or \
+                (node.type, node.pk) in trail]
+        if not opened:
+            break
+        nodes = [child for node in opened for child in node.values()]
+        if not nodes:
+            # Whether the open nodes are active depends on the path ending here.
+            key.append(len(path) > depth + 1 and MORE or END)
+        depth += 1
+    return tuple(key)
+
+
+fragment_cache = FragmentCache(NAVIGATION_FRAGMENT_CACHE_SIZE)
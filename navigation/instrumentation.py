@@ -0,0 +1,73 @@
+"""
+Timing of the navigation's main operations, reported through the signals in
+``navigation.signals`` and the optional ``NAVIGATION_STATS_CALLBACK``.
+
+Measuring an operation is a pair of calls::
+
+    started = start('grow')
+    ...
+    finish('grow', started, sender, menu=name, node_count=count)
+
+When nothing listens for an event, ``start`` returns None and ``finish`` does
+nothing, so the cost of uninstrumented operations is a couple of attribute
+lookups.
+"""
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.importlib import import_module
+
+from navigation import signals
+from navigation.app_settings import NAVIGATION_STATS_CALLBACK
+
+
+SIGNALS = {
+    'grow': signals.menu_grown,
+    'recache': signals.menu_recached,
+    'render': signals.menu_rendered,
+}
+
+
+def _load_callback(path):
+    if not path:
+        return None
+    module_name, name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), name)
+
+callback = _load_callback(NAVIGATION_STATS_CALLBACK)
+
+
+def _query_count():
+    # Queries are only logged by debug cursors.
+    if settings.DEBUG or getattr(connection, 'use_debug_cursor', False):
+        return len(connection.queries)
+    return None
+
+
+def start(event):
+    """
+    Returns the starting state of a measurement of the given event, or None
+    if nothing listens for it.
+    """
+    if callback is None and not SIGNALS[event].receivers:
+        return None
+    return time.time(), _query_count()
+
+
+def finish(event, started, sender, **data):
+    """
+    Report the event whose measurement was started with ``start``, with the
+    given data, through its signal and the stats callback.
+    """
+    if started is None:
+        return
+    start_time, start_queries = started
+    end_queries = _query_count()
+    data['duration'] = time.time() - start_time
+    data['query_count'] = None
+    if start_queries is not None and end_queries is not None:
+        data['query_count'] = end_queries - start_queries
+    SIGNALS[event].send(sender=sender, **data)
+    if callback is not None:
+        callback(event, **data)
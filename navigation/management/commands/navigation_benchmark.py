@@ -0,0 +1,60 @@
+from optparse import make_option
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from navigation.benchmark import run_benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        'Builds a synthetic page tree and menu in a throwaway SQLite database and '
+        'reports the wall time, query count and memory growth of building, rendering '
+        'and recaching it.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--width', dest='width', type='int', default=5,
+            help='The number of menu items at each level of the menu.'),
+        make_option('--depth', dest='depth', type='int', default=3,
+            help='The number of levels of the menu.'),
+        make_option('--mix', dest='mix', default='folder=1,link=1,page=2',
+            help='The relative weights of each type of menu item.'),
+        make_option('--page-width', dest='page_width', type='int', default=5,
+            help='The number of child pages of each page.'),
+        make_option('--page-depth', dest='page_depth', type='int', default=3,
+            help='The number of levels of the page tree.'),
+        make_option('--iterations', dest='iterations', type='int', default=20,
+            help='The number of times each stage is run.'),
+        make_option('-o', '--output', dest='output', default=None,
+            help='Write the results as JSON to this file.'),
+    )
+
+    def handle(self, *args, **options):
+        if 'sqlite3' not in connection.settings_dict['ENGINE']:
+            raise CommandError('The benchmarks must be run with a SQLite database.')
+        verbosity = int(options.get('verbosity', 1))
+        old_name = connection.creation.create_test_db(verbosity=verbosity, autoclobber=True)
+        try:
+            results = run_benchmarks(
+                width=options['width'],
+                depth=options['depth'],
+                mix=options['mix'],
+                page_width=options['page_width'],
+                page_depth=options['page_depth'],
+                iterations=options['iterations'],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity)
+        if options.get('output'):
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+        for result in results['results']:
+            rss_delta = result['rss_delta_kb']
+            self.stdout.write('%-22s %10.5fs %8.1f queries %10s KB RSS delta %10d KB peak growth\n' % (
+                result['stage'],
+                result['mean_time'],
+                result['mean_queries'],
+                rss_delta is None and 'n/a' or rss_delta,
+                result['max_rss_growth_kb'],
+            ))
@@ -0,0 +1,32 @@
+from optparse import make_option
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from navigation.bulk import dump_menus
+from navigation.models import Menu
+
+
+class Command(BaseCommand):
+    args = '[menu name ...]'
+    help = 'Dumps the given menus (or all menus) and their items as JSON.'
+    option_list = BaseCommand.option_list + (
+        make_option('-o', '--output', dest='output', default=None,
+            help='Write the dump to this file rather than to standard output.'),
+        make_option('--indent', dest='indent', type='int', default=None,
+            help='Indent the JSON by this many spaces.'),
+    )
+
+    def handle(self, *args, **options):
+        menus = Menu.objects.all()
+        if args:
+            menus = list(menus.filter(name__in=args))
+            missing = set(args) - set([menu.name for menu in menus])
+            if missing:
+                raise CommandError('Unknown menus: %s' % ', '.join(sorted(missing)))
+        dump = json.dumps(dump_menus(menus), indent=options.get('indent'))
+        if options.get('output'):
+            with open(options['output'], 'w') as output:
+                output.write(dump)
+        else:
+            self.stdout.write(dump + '\n')
@@ -0,0 +1,31 @@
+from optparse import make_option
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from navigation.bulk import load_menus
+
+
+class Command(BaseCommand):
+    args = '<dump file>'
+    help = 'Loads menus from a JSON dump written by navigation_dump.'
+    option_list = BaseCommand.option_list + (
+        make_option('--replace', action='store_true', dest='replace', default=False,
+            help='Replace the items of menus that already exist.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: navigation_load %s' % self.args)
+        try:
+            with open(args[0]) as dump_file:
+                data = json.load(dump_file)
+        except (IOError, ValueError) as e:
+            raise CommandError('Could not read %s: %s' % (args[0], e))
+        start = time.time()
+        try:
+            menus = load_menus(data, replace=options.get('replace'))
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write('Loaded %d menus in %.2f seconds.\n' % (len(menus), time.time() - start))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from navigation.app_settings import NAVIGATION_SNAPSHOT_PATH
+
+
+class Command(BaseCommand):
+    args = '[path]'
+    help = (
+        'Builds every menu from the database and writes the navigation trees '
+        'to a snapshot file (NAVIGATION_SNAPSHOT_PATH by default).'
+    )
+
+    def handle(self, *args, **options):
+        from navigation.cache import SiteNav
+        if len(args) > 1:
+            raise CommandError('Usage: navigation_snapshot %s' % self.args)
+        path = args and args[0] or NAVIGATION_SNAPSHOT_PATH
+        if not path:
+            raise CommandError('Provide a path or set NAVIGATION_SNAPSHOT_PATH.')
+        site_nav = SiteNav(snapshot_path=None)
+        site_nav.dump(path)
+        self.stdout.write('Wrote a snapshot of %d menus to %s\n' % (len(site_nav.keys()), path))
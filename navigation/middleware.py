@@ -0,0 +1,19 @@
+class CoalescedRecacheMiddleware(object):
+    """
+    With ``NAVIGATION_RECACHE_MODE`` set to 'coalesce' or 'background',
+    collects the menus changed while handling a request and recaches each of
+    them once, after the response has been produced.
+
+    Place it above ``django.middleware.transaction.TransactionMiddleware`` in
+    ``MIDDLEWARE_CLASSES``, so that the request's transaction has been
+    committed by the time the menus are recached.
+    """
+
+    def process_request(self, request):
+        from navigation.cache import site_nav
+        site_nav.begin_request()
+
+    def process_response(self, request, response):
+        from navigation.cache import site_nav
+        site_nav.end_request()
+        return response
@@ -6,7 +6,7 @@ from django.core.urlresolvers import reverse
 from mptt.models import MPTTModel, TreeForeignKey
 
 from pagemanager.app_settings import PAGEMANAGER_PAGE_MODEL
-from pagemanager.models import attach_generics
+from navigation.prefetch import prefetch_page_children
 
 
 class MenuItem(MPTTModel):
@@ -31,6 +31,13 @@ class MenuItem(MPTTModel):
     def get_delete_url(self):
         return self.obj.get_delete_url()
 
+    def delete(self, *args, **kwargs):
+        # Deleting an item cascades to every item below it, each of which
+        # would otherwise recache the menu on its own.
+        from navigation.cache import site_nav
+        with site_nav.coalesced():
+            super(MenuItem, self).delete(*args, **kwargs)
+
 
 class BaseMenuLeaf(models.Model):
     menu_items = generic.GenericRelation(MenuItem, object_id_field="obj_id", \
@@ -52,6 +59,13 @@ class BaseMenuLeaf(models.Model):
         )
         mi.save()
 
+    def delete(self, *args, **kwargs):
+        # Deleting a leaf cascades to its menu items and every item below
+        # them; recache the affected menus once when it's done.
+        from navigation.cache import site_nav
+        with site_nav.coalesced():
+            super(BaseMenuLeaf, self).delete(*args, **kwargs)
+
     def get_edit_url(self):
         return reverse('admin:%s_%s_change' % (
             self._meta.app_label,
@@ -84,11 +98,12 @@ class MenuPage(BaseMenuLeaf):
         )
 
     def get_page_children(self):
-        level = None
-        level_num = None
-        pages = [page for page in self.page.get_descendants() if page.level <= self.depth]
-        attach_generics(pages)
-        return pages
+        # The descendants of the page down to ``depth`` levels below it. Cached
+        # on the instance, so that menus loaded once by the {% menu %} tag don't
+        # query for their pages again on every render; ``prefetch_page_children``
+        # loads them for many menu pages at once.
+        prefetch_page_children([self])
+        return self._page_children
 
 class MenuFolder(BaseMenuLeaf):
     node_type = "folder"
@@ -0,0 +1,166 @@
+"""
+Bulk loading of the objects related to menu items, to avoid a query per item.
+
+The ``{% menu %}`` tag, ``SiteNav`` and the admin all share these helpers.
+"""
+from bisect import bisect_left, bisect_right
+from operator import or_
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import ForeignKey, Q
+from django.db.models.fields import FieldDoesNotExist
+
+from pagemanager.models import attach_generics
+
+
+# The name under which ``prefetch_menu_items`` accepts page layouts, which
+# pagemanager attaches to pages with ``attach_generics`` (see
+# ``attach_page_layouts``).
+PAGE_LAYOUT = 'page_layout'
+
+
+def prefetch_generics(objects, ct_field='obj_type', fk_field='obj_id', attr='obj'):
+    """
+    Resolve the generic foreign key ``attr`` of each of the given objects,
+    with one query per content type. Content types come from the
+    ``ContentType`` cache. Returns the list of related objects.
+    """
+    ids = {}
+    for obj in objects:
+        ids.setdefault(getattr(obj, ct_field + '_id'), set()).add(getattr(obj, fk_field))
+    related = {}
+    for ct_id, fk_list in ids.items():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        related[ct_id] = model._default_manager.in_bulk(list(fk_list))
+    attached = []
+    for obj in objects:
+        value = related[getattr(obj, ct_field + '_id')].get(getattr(obj, fk_field))
+        if value is not None:
+            setattr(obj, attr, value)
+            attached.append(value)
+    return attached
+
+
+def prefetch_foreign_key(objects, name):
+    """
+    Attach the targets of the foreign key called ``name`` to those of the given
+    objects that have one, with one query per target model. Returns the list
+    of targets.
+    """
+    ids = {}
+    for obj in objects:
+        try:
+            field = obj._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if isinstance(field, ForeignKey) and getattr(obj, field.attname) is not None:
+            ids.setdefault(field.rel.to, set()).add(getattr(obj, field.attname))
+    targets = dict(
+        [(model, model._default_manager.in_bulk(list(pks))) for model, pks in ids.items()]
+    )
+    attached = []
+    for obj in objects:
+        try:
+            field = obj._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if field.rel is not None and field.rel.to in targets:
+            target = targets[field.rel.to].get(getattr(obj, field.attname))
+            if target is not None:
+                setattr(obj, name, target)
+                attached.append(target)
+    return attached
+
+
+def prefetch_menu_items(items, related=()):
+    """
+    Attach the leaf object (``obj``) of each of the given ``MenuItem``
+    objects, and then the relations named in ``related``, each given as a
+    dotted path from the leaf objects, e.g. ``('page', 'page.page_layout')``
+    to attach the pages of ``MenuPage`` leaves and their layouts.
+    """
+    levels = {'': prefetch_generics(items)}
+    # Sorting puts every path after its parent.
+    for path in sorted(related):
+        parent_path, _, name = path.rpartition('.')
+        objects = levels.get(parent_path, [])
+        if name == PAGE_LAYOUT:
+            attach_page_layouts(objects)
+            levels[path] = []
+        else:
+            levels[path] = prefetch_foreign_key(objects, name)
+    return items
+
+
+def _has_layout(page):
+    # Layouts are either assigned as plain attributes or held in the cache of
+    # the generic foreign key.
+    return PAGE_LAYOUT in page.__dict__ or hasattr(page, '_%s_cache' % PAGE_LAYOUT)
+
+
+def attach_page_layouts(pages):
+    """
+    Attach the page layout (which holds ``nav_name_override``, ``show_in_nav``
+    and ``show_children``) to each of the given pages that doesn't have it
+    yet, with one ``attach_generics`` call for all of them. Returns the list
+    of pages.
+    """
+    pages = list(pages)
+    missing = [page for page in pages if not _has_layout(page)]
+    if missing:
+        attach_generics(missing)
+    return pages
+
+
+def prefetch_descendants(roots, layouts=True):
+    """
+    Load the descendants of each of the given ``(page, depth)`` pairs, down to
+    ``depth`` levels below the page (all of them if ``depth`` is None, none if
+    it is 0), with a single query bounded by MPTT range and level, and attach
+    their page layouts unless ``layouts`` is False. Returns a dictionary of
+    lists of descendants in tree order, keyed by ``(page id, depth)``.
+    """
+    ranges = []
+    for page, depth in roots:
+        if depth == 0:
+            continue
+        bounds = Q(tree_id=page.tree_id, lft__gt=page.lft, rght__lt=page.rght)
+        if depth is not None:
+            bounds &= Q(level__lte=page.level + depth)
+        ranges.append(bounds)
+    trees, tree_lfts = {}, {}
+    if ranges:
+        manager = roots[0][0].__class__._default_manager
+        pages = list(manager.filter(reduce(or_, ranges)).order_by('tree_id', 'lft'))
+        if layouts:
+            attach_page_layouts(pages)
+        for page in pages:
+            trees.setdefault(page.tree_id, []).append(page)
+            tree_lfts.setdefault(page.tree_id, []).append(page.lft)
+    descendants = {}
+    for page, depth in roots:
+        tree, lfts = trees.get(page.tree_id, []), tree_lfts.get(page.tree_id, [])
+        # Descendants are the pages of the same tree between the page's
+        # ``lft`` and ``rght``.
+        start, end = bisect_right(lfts, page.lft), bisect_left(lfts, page.rght)
+        if depth == 0:
+            start = end
+        descendants[(page.pk, depth)] = [descendant for descendant in tree[start:end] \
+            if depth is None or descendant.level <= page.level + depth]
+    return descendants
+
+
+def prefetch_page_children(menu_pages, layouts=True):
+    """
+    Attach the descendants returned by ``MenuPage.get_page_children`` to each
+    of the given ``MenuPage`` objects, with a single query for all of them,
+    and their page layouts unless ``layouts`` is False.
+    """
+    menu_pages = [menu_page for menu_page in menu_pages \
+        if not hasattr(menu_page, '_page_children')]
+    descendants = prefetch_descendants(
+        [(menu_page.page, menu_page.depth) for menu_page in menu_pages], layouts
+    )
+    for menu_page in menu_pages:
+        menu_page._page_children = descendants[(menu_page.page.pk, menu_page.depth)]
+    return menu_pages
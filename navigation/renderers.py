@@ -0,0 +1,106 @@
+"""
+Renderers turn a single navigation node, along with its already-rendered
+children, into the HTML of its ``<li>`` element for ``fast_menu``.
+
+A renderer is instantiated with the name of a menu's template and called with
+the same dictionary that ``render_node`` has always passed to that template.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.template import Context
+from django.template.loader import get_template, render_to_string
+from django.utils.encoding import force_unicode
+from django.utils.html import conditional_escape
+from django.utils.importlib import import_module
+
+from navigation.app_settings import NAVIGATION_DEFAULT_RENDERER, NAVIGATION_RENDERERS
+
+
+class TemplateRenderer(object):
+    """
+    Renders each node with ``render_to_string``, looking the template up and
+    rendering it afresh for every node.
+    """
+
+    def __init__(self, template_name):
+        self.template_name = template_name
+
+    def __call__(self, context):
+        return render_to_string(self.template_name, context)
+
+
+class CompiledTemplateRenderer(object):
+    """
+    Renders each node with a template that is looked up and compiled only
+    once, skipping the template loaders on every node.
+    """
+
+    def __init__(self, template_name):
+        self.template_name = template_name
+        self.template = get_template(template_name)
+
+    def __call__(self, context):
+        return self.template.render(Context(context))
+
+
+class StringRenderer(object):
+    """
+    Builds the markup of ``navigation/node.html`` directly with a single join,
+    without involving the template system at all. It can only stand in for
+    that template.
+    """
+
+    template_name = 'navigation/node.html'
+
+    def __init__(self, template_name):
+        if template_name != self.template_name:
+            raise ImproperlyConfigured("The 'string' renderer can only render %r, not %r." % \
+                (self.template_name, template_name))
+
+    def __call__(self, context):
+        node = context['node']
+        children = context['children']
+        if node.url:
+            link = (u'<a href="', conditional_escape(force_unicode(node.url)), u'">', \
+                conditional_escape(force_unicode(node.title)), u'</a>')
+        else:
+            link = (u'<span>', conditional_escape(force_unicode(node.title)), u'</span>')
+        return u''.join((
+            u'<li class="', conditional_escape(force_unicode(context['html_class_name'])),
+            context['active'] and u' active' or u'', u'">',
+        ) + link + (
+            children and u'<ul>' or u'', children or u'', children and u'</ul>' or u'',
+            u'</li>',
+        ))
+
+
+RENDERERS = {
+    'compiled': CompiledTemplateRenderer,
+    'string': StringRenderer,
+    'template': TemplateRenderer,
+}
+
+_renderers = {}
+
+
+def get_renderer_class(name):
+    """
+    Returns the renderer class registered under the given name, or found at
+    the given dotted path.
+    """
+    if name in RENDERERS:
+        return RENDERERS[name]
+    module_name, class_name = name.rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)
+
+
+def get_renderer(template_name, name=None):
+    """
+    Returns the renderer configured for the given menu template (or the named
+    one), reusing a single instance per template and renderer.
+    """
+    if name is None:
+        name = NAVIGATION_RENDERERS.get(template_name, NAVIGATION_DEFAULT_RENDERER)
+    key = (template_name, name)
+    if key not in _renderers:
+        _renderers[key] = get_renderer_class(name)(template_name)
+    return _renderers[key]
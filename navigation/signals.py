@@ -0,0 +1,19 @@
+from django.dispatch import Signal
+
+
+# Instrumentation signals, sent by ``navigation.instrumentation`` only when
+# they have receivers (or a stats callback is configured). Every signal
+# provides the name of the ``menu``, the ``duration`` in seconds, the
+# ``node_count`` of the menu and the ``query_count`` (None unless queries are
+# being logged).
+
+# Sent when a menu tree has been built from the database. ``trigger`` names
+# what caused the build, e.g. the signal handler that recached the menu.
+menu_grown = Signal(providing_args=['menu', 'duration', 'node_count', 'query_count', 'trigger'])
+
+# Sent when a menu has been recached, fully or incrementally.
+menu_recached = Signal(providing_args=['menu', 'duration', 'node_count', 'query_count', 'trigger'])
+
+# Sent when ``fast_menu`` has rendered a menu. ``cache_hit`` is True when the
+# fragment came from the fragment cache.
+menu_rendered = Signal(providing_args=['menu', 'duration', 'node_count', 'query_count', 'cache_hit'])
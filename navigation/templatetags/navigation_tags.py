@@ -1,13 +1,17 @@
 from functools import partial
+import copy
 import re
 
 from django import template
 from django.template.loader import render_to_string
-from django.contrib.contenttypes.models import ContentType
 
+from navigation import instrumentation
+from navigation.audiences import get_audience
+from navigation.fragments import fragment_cache, path_key, same_node
 from navigation.models import Menu, MenuItem
-from pagemanager.models import Page
-from pagemanager.models import attach_generics as attach_page_generics
+from navigation.prefetch import PAGE_LAYOUT, attach_page_layouts, prefetch_menu_items, \
+    prefetch_page_children
+from navigation.renderers import get_renderer
 
 
 # Regex that matches on leading or trailing slashes.
@@ -20,32 +24,89 @@ register = template.Library()
 def attach_menu_generics(queryset, prefetch_pages=False):
     # manually attach generic relations to avoid a ridiculous
     # amount of database calls
-    generics = {}
-    for item in queryset:
-        # create a dictionary of object ids per content type id
-        generics.setdefault(item.obj_type_id, set()).add(item.obj_id)
-    # fetch all associated content types with the queryset
-    content_types = ContentType.objects.in_bulk(generics.keys())
-    relations = {}
-    for ct, fk_list in generics.items():
-        # for every content type, fetch all the object ids of that type
-        ct_model = content_types[ct].model_class()
-        relations[ct] = ct_model.objects.in_bulk(list(fk_list))
-    for item in queryset:
-        setattr(item, 'obj', relations[item.obj_type_id][item.obj_id])
-    # prefetch page for all page items
-    if not prefetch_pages:
-        return
-    pages = []
-    for item in queryset:
-        if item.obj.node_type == "page":
-            pages.append(item.obj.page_id)
-    pages = Page.objects.filter(id__in=pages)
-    attach_page_generics(pages)
-    pages = dict((page.id, page) for page in pages)
-    for item in queryset:
-        if item.obj.node_type == "page":
-            item.obj.page = pages[item.obj.page_id]
+    related = prefetch_pages and ('page', 'page.%s' % PAGE_LAYOUT) or ()
+    prefetch_menu_items(queryset, related)
+
+
+# The menus loaded by the {% menu %} tag, keyed by lowercased name, as
+# ``(version, menu, menu items)`` tuples.
+_loaded_menus = {}
+
+
+def load_menu(menu_name):
+    """
+    Returns the ``Menu`` with the given name (case-insensitively) and a list
+    of its ``MenuItem`` objects, with their generic relations, pages and page
+    children attached, and the URL of each page stored as ``cached_url``.
+
+    The menu is only loaded from the database again once its version stamp
+    has moved; in between, each call returns fresh copies of the loaded
+    objects, so that concurrent renders don't share template state.
+    """
+    from navigation.cache import site_nav
+    lookup = menu_name.lower()
+    names = [name for name in site_nav.keys() if name.lower() == lookup]
+    version = names and site_nav.get_version(names[0]) or None
+    loaded = _loaded_menus.get(lookup)
+    if version is None or loaded is None or loaded[0] != version:
+        menu = Menu.objects.get(name__iexact=menu_name)
+        nodes = list(MenuItem.objects.filter(menu=menu))
+        # One query per leaf type, one for the pages, one for their page
+        # children and one layout attach for all of those pages.
+        prefetch_menu_items(nodes, ('page',))
+        prefetch_page_children([node.obj for node in nodes if node.obj.node_type == "page"],
+            layouts=False)
+        attach_page_layouts(_menu_pages(nodes))
+        for page in _menu_pages(nodes):
+            page.cached_url = page.get_absolute_url()
+        loaded = (version, menu, nodes)
+        if version is not None:
+            _loaded_menus[lookup] = loaded
+    _, menu, nodes = loaded
+    return menu, [_copy_menu_item(node) for node in nodes]
+
+
+def _copy_menu_item(node):
+    node = copy.copy(node)
+    node.obj = copy.copy(node.obj)
+    if node.obj.node_type == "page":
+        node.obj.page = copy.copy(node.obj.page)
+    if hasattr(node.obj, '_page_children'):
+        node.obj._page_children = [copy.copy(page) for page in node.obj._page_children]
+    return node
+
+
+def _menu_pages(nodes):
+    """
+    Yields the pages of the given menu items, and their page children.
+    """
+    for node in nodes:
+        if node.obj.node_type == "page":
+            yield node.obj.page
+            for page in node.obj.get_page_children():
+                yield page
+
+
+def page_url(page):
+    """
+    Returns the URL of the given page, as stored by ``load_menu`` if it was.
+    """
+    url = getattr(page, 'cached_url', None)
+    if url is None:
+        url = page.get_absolute_url()
+    return url
+
+
+def mark_active_pages(nodes, path):
+    """
+    Flag each page of the given menu items (and their page children) with
+    ``is_active_page`` if its URL is the given path, and ``is_active_trail``
+    if its URL leads to it, in one pass over the menu.
+    """
+    for page in _menu_pages(nodes):
+        url = page_url(page)
+        page.is_active_page = url == path
+        page.is_active_trail = path.startswith(url)
 
 
 class RenderMenuNode(template.Node):
@@ -62,9 +123,8 @@ class RenderMenuNode(template.Node):
             # homepage
             path = "/"
 
-        menu = Menu.objects.get(name__iexact=self.menu_name)
-        nodes = list(MenuItem.objects.filter(menu=menu))
-        attach_menu_generics(nodes, prefetch_pages=True)
+        menu, nodes = load_menu(self.menu_name)
+        mark_active_pages(nodes, path)
         template = menu.template
 
         return render_to_string(template, {
@@ -88,16 +148,41 @@ def menu(parser, token):
     return RenderMenuNode(menu_name)
 
 
+@register.inclusion_tag('navigation/breadcrumbs.html', takes_context=True)
+def breadcrumbs(context, menu_name):
+    """
+    Renders the breadcrumbs leading to the current page in the menu with the
+    given name, as found by ``SiteNav.get_trail`` among the nodes shown to the
+    request's audience.
+    """
+    from navigation.cache import site_nav
+    request = context.get('request')
+    try:
+        path = request.META['PATH_INFO']
+    except AttributeError:
+        # homepage
+        path = "/"
+    if menu_name not in site_nav:
+        return {'crumbs': [], 'path': path}
+    site_nav.sync(menu_name)
+    try:
+        crumbs = site_nav.get_trail(menu_name, path, get_audience(request))
+    except KeyError:
+        # The menu has just been deleted.
+        crumbs = []
+    return {'crumbs': crumbs, 'path': path}
+
+
 @register.filter(name='show_active_page')
 def show_active_page(value, arg):
-    if value.get_absolute_url() == arg:
+    if page_url(value) == arg:
         return "active"
     else:
         return ""
 
 @register.filter(name='show_active_trail')
 def show_active_trail(value, arg):
-    if arg.startswith(value.get_absolute_url()):
+    if arg.startswith(page_url(value)):
         return "active-trail"
     else:
         return ""
@@ -116,7 +201,7 @@ def plustwo(value):
     return value + 2
 
 
-def fast_menu(request, nav_name, prefix=None):
+def fast_menu(request, nav_name, prefix=None, renderer=None, max_depth=None, trail_only=False):
     """
     Render the given menu item (by name).
 
@@ -125,12 +210,31 @@ def fast_menu(request, nav_name, prefix=None):
 
     prefix can be a string with an initial, ignorable part of the path (e.g. resources)
 
+    renderer can be the name of a renderer (see ``navigation.renderers``) to
+    use instead of the one configured for the menu's template.
+
+    max_depth can be the number of levels of the menu to render; only the
+    nodes leading to the current page are expanded past it. With trail_only,
+    folders aren't expanded either unless they are on that trail. The trail is
+    the one found by ``SiteNav.get_trail``, folders included.
+
+    The menu is rendered from the variant of its tree pruned for the user's
+    audience (see ``navigation.audiences``), so nodes hidden from the user
+    are never rendered and templates needn't check their visibility.
+
     """
     from navigation.cache import site_nav
     if nav_name not in site_nav:
         #raise KeyError('Unknown site nav name: "%s"' % nav_name)
         return None
-    container, menu_list = site_nav[nav_name]
+    started = instrumentation.start('render')
+    site_nav.sync(nav_name)
+    audience = get_audience(request)
+    try:
+        container, menu_list = site_nav.get_variant(nav_name, audience)
+    except KeyError:
+        # The menu has just been deleted.
+        return None
     # Strip outer slashes and split path into a list of slugs.
     try:
         path = outer_slashes.sub("", request.META['PATH_INFO']).split("/")
@@ -139,9 +243,47 @@ def fast_menu(request, nav_name, prefix=None):
     except (KeyError, AttributeError):
         # We have a homepage path.
         path = []
-    # Bind the ``container`` and ``request`` variables to the function: they will not change on any call.
-    _render_node = partial(render_node, container, request)
-    return "".join([_render_node(node, path) for node in menu_list])
+    trail = active_node = None
+    if trail_only or max_depth is not None:
+        # Folders have no slug to follow down the path, so the nodes to open
+        # are looked up by URL instead.
+        try:
+            request_path = request.META['PATH_INFO']
+        except (KeyError, AttributeError):
+            request_path = "/"
+        try:
+            trail = frozenset([(node.type, node.pk) \
+                for node in site_nav.get_trail(nav_name, request_path, audience)])
+            active_node = site_nav.get_active_node(nav_name, request_path, audience)
+        except KeyError:
+            # The menu has just been deleted.
+            return None
+    cache_key = (
+        nav_name,
+        site_nav.versions.get(nav_name),
+        renderer,
+        audience,
+        max_depth,
+        trail_only,
+        path_key(menu_list, path, max_depth, trail_only, trail, active_node),
+    )
+    fragment = fragment_cache.get(cache_key)
+    if fragment is not None:
+        if started is not None:
+            instrumentation.finish('render', started, site_nav.__class__, menu=nav_name, \
+                node_count=site_nav.node_count(nav_name), cache_hit=True)
+        return fragment
+    # Bind the ``container``, ``request`` and ``renderer`` variables to the function: they will
+    # not change on any call.
+    _render_node = partial(render_node, container, request,
+        renderer=get_renderer(container.template, renderer), max_depth=max_depth,
+        trail_only=trail_only, trail=trail, active_node=active_node)
+    fragment = "".join([_render_node(node, path) for node in menu_list])
+    fragment_cache.set(cache_key, fragment)
+    if started is not None:
+        instrumentation.finish('render', started, site_nav.__class__, menu=nav_name, \
+            node_count=site_nav.node_count(nav_name), cache_hit=False)
+    return fragment
 fast_menu.function = True
 fast_menu.takes_request = True
 
@@ -157,22 +299,45 @@ def get_html_class_name(node, is_open):
     return class_name.strip()
 
 
-def render_node(container, request, node, path, level=2):
+def render_node(container, request, node, path, level=2, renderer=None, max_depth=None,
+    trail_only=False, trail=None, active_node=None):
     """
     A function that can recursively render <li> elements representing a navigation object.
+
+    Each node is rendered by ``renderer``, or with ``render_to_string`` and the
+    container's template if no renderer is given.
+
+    Folders are open unless ``trail_only`` is set or they are ``max_depth``
+    levels deep; nodes on the path are always open. If given, ``trail`` is the
+    set of the ``(node type, pk)`` of the nodes on the active trail, which are
+    then the nodes on the path, folders included, and only ``active_node`` (the
+    node whose URL is the request's path) is active.
     """
     slug = getattr(node, 'slug', None)
-    is_open = (path and path[0] == slug) or node.type == "folder"
-    active = is_open and len(path) == 1
+    if trail is None:
+        on_path = path and path[0] == slug
+    else:
+        on_path = (node.type, node.pk) in trail
+    is_open = on_path or (node.type == "folder" and not trail_only \
+        and (max_depth is None or level <= max_depth))
+    if trail is None:
+        active = is_open and len(path) == 1
+    else:
+        active = active_node is not None and same_node(node, active_node)
     html_class_name = get_html_class_name(node, is_open)
     lowest_level = level == 2
     if is_open and not node.is_leaf:
         path = path[1:]
         lower_level = level + 1
-        children = "".join([render_node(container, request, child, path, level=lower_level) for child in node.values()])
+        children = "".join([render_node(container, request, child, path, level=lower_level, \
+            renderer=renderer, max_depth=max_depth, trail_only=trail_only, trail=trail, \
+            active_node=active_node) \
+            for child in node.values()])
     else:
         children = None
-    return render_to_string(container.template, {
+    if renderer is None:
+        renderer = partial(render_to_string, container.template)
+    return renderer({
         'active': active,
         'children': children,
         'html_class_name': html_class_name,
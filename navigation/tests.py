@@ -0,0 +1,555 @@
+import multiprocessing
+import shutil
+import tempfile
+
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from navigation import cache
+from navigation.audiences import prune
+from navigation.bulk import rebuild_menu_tree
+from navigation.cache import NAMES_VERSION_KEY, SiteNav
+from navigation.compact import freeze
+from navigation.fragments import fragment_cache, path_key
+from navigation.models import Menu, MenuFolder, MenuItem, MenuLink, MenuPage
+from navigation.renderers import StringRenderer, get_renderer
+from navigation.templatetags.navigation_tags import fast_menu
+from pagemanager.models import Page
+from pagemanager.signals import page_edited
+
+
+def _cold_start(backend, location, results):
+    """
+    Start a fresh ``SiteNav`` on the given cache, as a newly started process
+    would, and report the version stamp it settles on.
+    """
+    nav = SiteNav(snapshot_path=None)
+    nav.version_cache = get_cache(backend, LOCATION=location)
+    results.put(nav.get_version('main'))
+
+
+class VersionStampTests(TestCase):
+    """
+    The shared version stamps, against the cache backends processes can use
+    to share them.
+    """
+    backends = (
+        'django.core.cache.backends.locmem.LocMemCache',
+        'django.core.cache.backends.filebased.FileBasedCache',
+    )
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.menu = Menu.objects.create(name='main')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def navs(self, backend, count=2):
+        """
+        Returns ``count`` ``SiteNav`` objects standing in for as many
+        processes, sharing a fresh cache of the given backend.
+        """
+        location = '%s/%s' % (self.cache_dir, backend.rsplit('.', 1)[-1])
+        navs = []
+        for i in range(count):
+            nav = SiteNav(snapshot_path=None)
+            nav.version_cache = get_cache(backend, LOCATION=location)
+            navs.append(nav)
+        navs[0].version_cache.clear()
+        return navs
+
+    def test_cold_start_agrees(self):
+        for backend in self.backends:
+            navs = self.navs(backend, 4)
+            versions = set([nav.get_version('main') for nav in navs])
+            self.assertEqual(len(versions), 1, backend)
+
+    def test_cold_start_agrees_across_processes(self):
+        # The local memory cache isn't shared between processes, so only the
+        # file cache can be exercised here.
+        backend = 'django.core.cache.backends.filebased.FileBasedCache'
+        location = '%s/processes' % self.cache_dir
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_cold_start, args=(backend, location, results)) \
+            for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        versions = set([results.get(timeout=5) for process in processes])
+        self.assertEqual(len(versions), 1)
+        nav = SiteNav(snapshot_path=None)
+        nav.version_cache = get_cache(backend, LOCATION=location)
+        self.assertEqual(nav.get_version('main'), versions.pop())
+
+    def test_publish_moves_stamp(self):
+        for backend in self.backends:
+            first, second = self.navs(backend)
+            version = second.get_version('main')
+            first._publish('main')
+            self.assertNotEqual(second.get_version('main'), version, backend)
+            self.assertEqual(second.get_version('main'), first.versions['main'], backend)
+
+    def test_evicted_stamp_is_restored(self):
+        for backend in self.backends:
+            nav, = self.navs(backend, 1)
+            nav['main']
+            version = nav.versions['main']
+            nav.version_cache.delete(nav._version_key('main'))
+            self.assertEqual(nav.get_version('main'), version, backend)
+
+    def test_sync_regrows_changed_menu(self):
+        for backend in self.backends:
+            first, second = self.navs(backend)
+            first['main']
+            second['main']
+            self.assertEqual(first.versions['main'], second.versions['main'], backend)
+            second.recache('main')
+            self.assertNotEqual(first.versions['main'], second.versions['main'], backend)
+            first.sync('main')
+            self.assertEqual(first.versions['main'], second.versions['main'], backend)
+
+    def test_sync_skips_menu_being_rebuilt(self):
+        first, second = self.navs(self.backends[0])
+        first['main']
+        second.recache('main')
+        lock = first._rebuild_lock('main')
+        lock.acquire()
+        try:
+            first.sync('main')
+            self.assertNotEqual(first.versions['main'], second.versions['main'])
+        finally:
+            lock.release()
+        first._version_checks.clear()
+        first.sync('main')
+        self.assertEqual(first.versions['main'], second.versions['main'])
+
+    def test_cold_cache_uses_snapshot(self):
+        path = '%s/snapshot' % self.cache_dir
+        for backend in self.backends:
+            writer, = self.navs(backend, 1)
+            writer['main']
+            writer.dump(path)
+            writer.version_cache.clear()
+            readers = self.navs(backend, 2)
+            for reader in readers:
+                reader.snapshot_path = path
+                reader._ensure('main')
+            self.assertEqual(readers[0].versions['main'], writer.versions['main'], backend)
+            self.assertEqual(readers[1].versions['main'], writer.versions['main'], backend)
+
+
+class MenuNamesTests(TestCase):
+    """
+    The list of menu names, as menus are added and deleted.
+    """
+
+    def setUp(self):
+        self.menu = Menu.objects.create(name='main')
+        Menu.objects.create(name='footer')
+        self.nav = SiteNav(snapshot_path=None)
+
+    def test_names_follow_other_processes(self):
+        self.assertEqual(sorted(self.nav.keys()), ['footer', 'main'])
+        Menu.objects.create(name='sidebar')
+        self.menu.delete()
+        self.assertEqual(sorted(self.nav.keys()), ['footer', 'sidebar'])
+
+    def test_stale_names_skip_deleted_menus(self):
+        self.nav.keys()
+        self.menu.delete()
+        # Names listed before the deletion, not yet checked again.
+        self.nav._names = ['footer', 'main']
+        self.nav._names_version = self.nav.version_cache.get(NAMES_VERSION_KEY)
+        self.assertEqual(self.nav.menus_containing('folder', 1), set())
+        self.assertRaises(KeyError, self.nav.__getitem__, 'main')
+        self.assertEqual(self.nav.keys(), ['footer'])
+
+
+def add_item(leaf, menu, parent=None):
+    """
+    Place the menu item created along with the given leaf in the given menu,
+    under the given item. Returns the item.
+    """
+    item = leaf.menu_items.all()[0]
+    item.menu, item.parent = menu, parent
+    item.save()
+    return item
+
+
+class FastMenuTrailTests(TestCase):
+    """
+    The ``trail_only`` and ``max_depth`` options of ``fast_menu``, on a trail
+    that runs through a folder.
+    """
+
+    def setUp(self):
+        self.old_site_nav = cache.site_nav
+        cache.site_nav = SiteNav(snapshot_path=None)
+        about = Page.objects.create(slug='about', title='About')
+        Page.objects.create(slug='team', title='Team', parent=about)
+        menu = Menu.objects.create(name='main', template='navigation/node.html')
+        folder = add_item(MenuFolder.objects.create(name='Folder'), menu)
+        add_item(MenuPage.objects.create(page=about, depth=1), menu, folder)
+        self.request = RequestFactory().get('/about/team/')
+
+    def tearDown(self):
+        cache.site_nav = self.old_site_nav
+
+    def test_trail_opens_folders(self):
+        for options in ({'trail_only': True}, {'max_depth': 1}):
+            html = fast_menu(self.request, 'main', renderer='string', **options)
+            self.assertTrue('<a href="/about/team/">Team</a>' in html, options)
+
+    def test_active_node_is_the_current_page(self):
+        for options in ({'trail_only': True}, {'max_depth': 1}):
+            html = fast_menu(self.request, 'main', renderer='string', **options)
+            self.assertTrue('active"><a href="/about/team/">' in html, options)
+            self.assertFalse('active"><a href="/about/">' in html, options)
+
+
+class PatchTests(TestCase):
+    """
+    Edits to folders and pages, which patch the menus containing them rather
+    than rebuilding them.
+    """
+
+    def setUp(self):
+        self.old_site_nav = cache.site_nav
+        cache.site_nav = self.nav = SiteNav(snapshot_path=None)
+        # Two pages with the same slug, at different places in the page tree.
+        self.page = Page.objects.create(slug='x', title='X',
+            parent=Page.objects.create(slug='a', title='A'))
+        other = Page.objects.create(slug='x', title='Other X',
+            parent=Page.objects.create(slug='b', title='B'))
+        menu = Menu.objects.create(name='main')
+        self.folder = MenuFolder.objects.create(name='Folder')
+        folder_item = add_item(self.folder, menu)
+        self.items = [add_item(MenuPage.objects.create(page=page, depth=0), menu, folder_item) \
+            for page in (self.page, other)]
+
+    def tearDown(self):
+        cache.site_nav = self.old_site_nav
+
+    def titles(self, folder):
+        return dict([(key, node.title) for key, node in folder.items()])
+
+    def test_page_edit_keeps_folder_keys(self):
+        keys = self.nav['main'][1][0].keys()
+        self.page.title = 'Edited'
+        self.page.save()
+        page_edited.send(sender=Page, page=self.page)
+        folder = self.nav['main'][1][0]
+        self.assertEqual(folder.keys(), keys)
+        self.assertEqual(self.titles(folder),
+            {self.items[0].pk: 'Edited', self.items[1].pk: 'Other X'})
+
+    def test_page_edit_leaves_published_tree_alone(self):
+        menu_list = self.nav['main'][1]
+        folder = menu_list[0]
+        self.page.title = 'Edited'
+        self.page.save()
+        page_edited.send(sender=Page, page=self.page)
+        self.assertTrue(self.nav['main'][1] is not menu_list)
+        self.assertTrue(menu_list[0] is folder)
+        self.assertEqual(self.titles(folder), {self.items[0].pk: 'X', self.items[1].pk: 'Other X'})
+
+    def test_folder_edit_leaves_published_tree_alone(self):
+        menu_list = self.nav['main'][1]
+        children = menu_list[0].values()
+        self.folder.name = 'Renamed'
+        self.folder.save()
+        self.assertEqual(menu_list[0].title, 'Folder')
+        folder = self.nav['main'][1][0]
+        self.assertEqual(folder.title, 'Renamed')
+        self.assertEqual(folder.values(), children)
+        self.assertEqual(len(self.nav.get_variant('main', 'anonymous')[1][0].values()), 2)
+
+    def test_node_index_follows_menu(self):
+        self.nav['main']
+        other = self.items[1].obj.page
+        self.assertEqual(self.nav.node_index[('page', other.pk)], frozenset(['main']))
+        self.items[1].delete()
+        self.assertFalse(('page', other.pk) in self.nav.node_index)
+        self.assertEqual(self.nav.menus_containing('page', self.page.pk), set(['main']))
+        Menu.objects.get(name='main').delete()
+        self.assertEqual(self.nav.node_index, {})
+
+
+class MenuPageTests(TestCase):
+    """
+    Edits to menu pages, which change their menus without touching any of
+    their menu items.
+    """
+
+    def setUp(self):
+        self.old_site_nav = cache.site_nav
+        cache.site_nav = self.nav = SiteNav(snapshot_path=None)
+        about = Page.objects.create(slug='about', title='About')
+        Page.objects.create(slug='team', title='Team', parent=about)
+        self.menu_page = MenuPage.objects.create(page=about, depth=0)
+        add_item(self.menu_page, Menu.objects.create(name='main'))
+
+    def tearDown(self):
+        cache.site_nav = self.old_site_nav
+
+    def test_edit_recaches_menu(self):
+        version = self.nav.get_version('main')
+        self.assertEqual(self.nav['main'][1][0].keys(), [])
+        self.menu_page.depth = 1
+        self.menu_page.save()
+        self.assertNotEqual(self.nav.get_version('main'), version)
+        self.assertEqual(self.nav['main'][1][0].keys(), ['team'])
+
+
+class UnbuiltMenuTests(TestCase):
+    """
+    Changes to menus that this process hasn't built, which only move their
+    stamps.
+    """
+
+    def setUp(self):
+        self.old_site_nav = cache.site_nav
+        cache.site_nav = self.nav = SiteNav(snapshot_path=None)
+        about = Page.objects.create(slug='about', title='About')
+        self.team = Page.objects.create(slug='team', title='Team', parent=about)
+        menu = Menu.objects.create(name='main')
+        self.folder = MenuFolder.objects.create(name='Folder')
+        add_item(MenuPage.objects.create(page=about, depth=1), menu, add_item(self.folder, menu))
+
+    def tearDown(self):
+        cache.site_nav = self.old_site_nav
+
+    def test_menus_containing_builds_nothing(self):
+        self.assertEqual(self.nav.menus_containing('folder', self.folder.pk), set(['main']))
+        self.assertEqual(self.nav.menus_containing('page', self.team.pk), set(['main']))
+        self.assertEqual(self.nav.menus_containing('link', self.folder.pk), set())
+        self.assertEqual(self.nav._published, {})
+
+    def test_edit_moves_stamp(self):
+        version = self.nav.get_version('main')
+        self.folder.name = 'Renamed'
+        self.folder.save()
+        self.assertEqual(self.nav._published, {})
+        self.assertNotEqual(self.nav.get_version('main'), version)
+        self.assertEqual(self.nav['main'][1][0].title, 'Renamed')
+
+
+class RendererTests(TestCase):
+
+    def test_string_renderer_only_renders_node_template(self):
+        self.assertTrue(isinstance(get_renderer('navigation/node.html', 'string'), StringRenderer))
+        self.assertRaises(ImproperlyConfigured, get_renderer, 'navigation/menu.html', 'string')
+
+
+class BulkTreeTests(TestCase):
+    """
+    ``rebuild_menu_tree``, whose numbering must match django-mptt's own
+    rebuild of the same parent links.
+    """
+
+    def setUp(self):
+        self.old_site_nav = cache.site_nav
+        cache.site_nav = SiteNav(snapshot_path=None)
+        self.menu = Menu.objects.create(name='main')
+        item = lambda name, parent=None: \
+            add_item(MenuFolder.objects.create(name=name), self.menu, parent).pk
+        self.a = item('A')
+        self.a1 = item('A1', MenuItem.objects.get(pk=self.a))
+        self.a1a = item('A1a', MenuItem.objects.get(pk=self.a1))
+        self.a2 = item('A2', MenuItem.objects.get(pk=self.a))
+        self.b = item('B')
+        self.b1 = item('B1', MenuItem.objects.get(pk=self.b))
+        self.c = item('C')
+
+    def tearDown(self):
+        cache.site_nav = self.old_site_nav
+
+    def tree_fields(self):
+        """
+        Returns the parent and nested set fields of every item, and the sets
+        of items sharing a tree, which don't depend on how trees are numbered.
+        """
+        items = list(MenuItem.objects.all())
+        trees = {}
+        for item in items:
+            trees.setdefault(item.tree_id, set()).add(item.pk)
+        return (
+            dict([(item.pk, (item.parent_id, item.lft, item.rght, item.level)) for item in items]),
+            set([frozenset(pks) for pks in trees.values()]),
+        )
+
+    def assertMatchesMptt(self, changes):
+        rebuild_menu_tree(self.menu, changes)
+        rebuilt = self.tree_fields()
+        MenuItem._tree_manager.rebuild()
+        self.assertEqual(rebuilt, self.tree_fields())
+        return rebuilt[0]
+
+    def children(self, fields, parent_id):
+        children = [(lft, pk) for pk, (parent, lft, rght, level) in fields.items() \
+            if parent == parent_id]
+        return [pk for lft, pk in sorted(children)]
+
+    def test_siblings_are_ordered(self):
+        fields = self.assertMatchesMptt({
+            self.a1: (self.a, 2), self.a2: (self.a, 1),
+            self.a: (None, 3), self.b: (None, 1), self.c: (None, 2),
+        })
+        self.assertEqual(self.children(fields, self.a), [self.a2, self.a1])
+
+    def test_moves_across_subtrees(self):
+        fields = self.assertMatchesMptt({
+            self.a1: (self.b, 2), self.b1: (self.b, 1),
+            self.c: (self.a2, 1), self.a2: (None, 4),
+        })
+        self.assertEqual(self.children(fields, self.b), [self.b1, self.a1])
+        self.assertEqual(self.children(fields, self.a1), [self.a1a])
+        self.assertEqual(self.children(fields, self.a2), [self.c])
+        self.assertEqual(fields[self.a1a][3], 2)
+        self.assertEqual(fields[self.a2][:4], (None, 1, 4, 0))
+
+    def test_parent_outside_menu(self):
+        footer = Menu.objects.create(name='footer')
+        outside = add_item(MenuFolder.objects.create(name='Outside'), footer).pk
+        fields = self.assertMatchesMptt({self.a1: (outside, 1)})
+        self.assertEqual(fields[self.a1], (None, 1, 4, 0))
+        self.assertEqual(fields[self.a1a][3], 1)
+        self.assertEqual(self.children(fields, outside), [])
+
+    def test_cycles_are_broken(self):
+        fields = self.assertMatchesMptt({self.a: (self.a1a, 1)})
+        roots = [pk for pk in (self.a, self.a1, self.a1a) if fields[pk][0] is None]
+        self.assertEqual(len(roots), 1)
+        self.assertEqual(fields[roots[0]][1:], (1, 8, 0))
+
+
+class PruneTests(TestCase):
+    """
+    The per-audience variants of built trees, and the compact trees they are
+    pruned from when ``NAVIGATION_COMPACT_TREES`` is set.
+    """
+
+    def setUp(self):
+        self.old_site_nav = cache.site_nav
+        cache.site_nav = self.nav = SiteNav(snapshot_path=None)
+        about = Page.objects.create(slug='about', title='About')
+        Page.objects.create(slug='team', title='Team', parent=about)
+        Page.objects.create(slug='staff', title='Staff', parent=about, visibility='private')
+        Page.objects.create(slug='draft', title='Draft', parent=about, status='draft')
+        private = Page.objects.create(slug='private', title='Private', visibility='private')
+        Page.objects.create(slug='inner', title='Inner', parent=private)
+        menu = Menu.objects.create(name='main')
+        folder = add_item(MenuFolder.objects.create(name='Folder'), menu)
+        add_item(MenuPage.objects.create(page=about, depth=1), menu, folder)
+        add_item(MenuLink.objects.create(name='Link', url='/link/'), menu)
+        add_item(MenuPage.objects.create(page=private, depth=1), menu)
+        self.menu_list = self.nav['main'][1]
+
+    def tearDown(self):
+        cache.site_nav = self.old_site_nav
+
+    def shape(self, nodes):
+        return [(node.type, node.pk, node.title, bool(getattr(node, 'first', False)), \
+            bool(getattr(node, 'last', False)), self.shape(node.values())) for node in nodes]
+
+    def titles(self, nodes):
+        titles = []
+        for node in nodes:
+            titles.append(node.title)
+            titles.extend(self.titles(node.values()))
+        return titles
+
+    def test_audiences(self):
+        self.assertEqual(self.titles(prune(self.menu_list, 'anonymous')),
+            ['Folder', 'About', 'Team', 'Link'])
+        self.assertEqual(self.titles(prune(self.menu_list, 'authenticated')),
+            ['Folder', 'About', 'Team', 'Staff', 'Link', 'Private', 'Inner'])
+
+    def test_top_level_flags(self):
+        pruned = prune(self.menu_list, 'anonymous')
+        self.assertEqual(self.shape(pruned)[-1][:5], ('link', pruned[-1].pk, 'Link', False, True))
+        self.assertFalse(getattr(self.menu_list[1], 'last', False))
+        self.assertTrue(self.menu_list[2].last)
+
+    def test_unchanged_subtrees_are_shared(self):
+        team = self.menu_list[0].values()[0].values()[0]
+        for audience in ('anonymous', 'authenticated'):
+            self.assertTrue(prune(self.menu_list, audience)[0].values()[0].values()[0] is team)
+        # The link is only the last top-level node for anonymous users.
+        self.assertTrue(prune(self.menu_list, 'authenticated')[1] is self.menu_list[1])
+        self.assertFalse(prune(self.menu_list, 'anonymous')[1] is self.menu_list[1])
+
+    def test_freeze_keeps_tree(self):
+        self.assertEqual(self.shape(freeze(self.menu_list)), self.shape(self.menu_list))
+
+    def test_compact_prune_matches_prune(self):
+        frozen = freeze(self.menu_list)
+        for audience in ('anonymous', 'authenticated'):
+            pruned = prune(frozen, audience)
+            self.assertEqual(self.shape(pruned), self.shape(prune(self.menu_list, audience)))
+            self.assertTrue(pruned[0].tree.columns is frozen[0].tree.columns)
+        self.assertEqual(self.shape(frozen), self.shape(self.menu_list))
+
+
+class PathKeyTests(TestCase):
+    """
+    ``path_key``, which must only give paths the same key if ``fast_menu``
+    renders them the same way.
+    """
+
+    paths = (
+        '/', '/about/', '/about/team/', '/about/jobs/', '/about/team/more/',
+        '/contact/', '/contact/more/', '/nowhere/', '/nowhere/else/', '/team/',
+    )
+    options = ({}, {'trail_only': True}, {'max_depth': 1}, {'max_depth': 2})
+
+    def setUp(self):
+        self.old_site_nav = cache.site_nav
+        cache.site_nav = self.nav = SiteNav(snapshot_path=None)
+        about = Page.objects.create(slug='about', title='About')
+        Page.objects.create(slug='team', title='Team', parent=about)
+        Page.objects.create(slug='jobs', title='Jobs', parent=about)
+        contact = Page.objects.create(slug='contact', title='Contact')
+        Page.objects.create(slug='more', title='More', parent=contact)
+        menu = Menu.objects.create(name='main', template='navigation/node.html')
+        folder = add_item(MenuFolder.objects.create(name='Folder'), menu)
+        add_item(MenuPage.objects.create(page=about, depth=2), menu, folder)
+        add_item(MenuPage.objects.create(page=contact, depth=0), menu)
+        # A menu of leaves only, in which the path can run past every open
+        # node.
+        footer = Menu.objects.create(name='footer', template='navigation/node.html')
+        add_item(MenuPage.objects.create(page=contact, depth=0), footer)
+        add_item(MenuLink.objects.create(name='Link', url='/link/'), footer)
+
+    def tearDown(self):
+        cache.site_nav = self.old_site_nav
+        fragment_cache.clear()
+
+    def key(self, name, url, max_depth=None, trail_only=False):
+        """
+        Returns the key of the given URL's path in the given menu, worked out
+        as ``fast_menu`` does.
+        """
+        container, menu_list = self.nav.get_variant(name, 'anonymous')
+        trail = active_node = None
+        if trail_only or max_depth is not None:
+            trail = frozenset([(node.type, node.pk) for node in self.nav.get_trail(name, url)])
+            active_node = self.nav.get_active_node(name, url)
+        return path_key(menu_list, url.strip('/').split('/'), max_depth, trail_only, \
+            trail, active_node)
+
+    def test_equal_keys_render_equally(self):
+        for name in ('main', 'footer'):
+            for options in self.options:
+                rendered = {}
+                for url in self.paths:
+                    fragment_cache.clear()
+                    html = fast_menu(RequestFactory().get(url), name, renderer='string', **options)
+                    rendered.setdefault(self.key(name, url, **options), set()).add(html)
+                for key, htmls in rendered.items():
+                    self.assertEqual(len(htmls), 1, (name, options, key))
+                self.assertTrue(len(rendered) > 1, (name, options))